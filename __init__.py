@@ -1,4 +1,10 @@
-from .io_volume import load_volume, save_volume
-from .io_mesh import load_mesh_geometry, save_mesh_geometry
+from .io_volume import load_volume, save_volume, configure_writer, \
+    wait_for_writes
+from .io_mesh import load_mesh_geometry, save_mesh_geometry, \
+    load_layered_mesh, save_layered_mesh
 from .volumetric_layering import create_levelsets, layering,  \
-    profile_sampling, profile_meshing
+    relayer, preview_layering, profile_sampling, profile_sampling_chunks, \
+    profile_meshing
+from .jvm import configure_vm, estimate_heap, memory_reports, heap_usage
+from .cache import configure_cache
+from .instrumentation import configure_instrumentation, log_sink, json_sink
@@ -0,0 +1,363 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+import numpy as np
+from io_volume import load_volume, wait_for_writes
+from jvm import configure_vm, estimate_heap
+from volumetric_layering import create_levelsets, layering, profile_sampling
+
+
+# seconds between checks whether the worker processes are still alive
+POLL_INTERVAL = 1.
+
+
+def read_manifest(manifest):
+
+    '''
+    Reads the list of subjects to process.
+
+        Parameters
+        -----------
+        manifest : Path to a CSV file with a header line, or to a JSON file
+            with a list of objects. Each entry needs the fields 'subject',
+            'gwb_prob' and 'cgb_prob' (tissue classifications inside the GM/WM
+            and CSF/GM surface) and can have 'intensity' (image to sample
+            profiles from) and 'out_dir' (defaults to the directory of
+            gwb_prob). Relative paths are relative to the manifest.
+
+        Returns
+        -------
+        List of dictionaries, one per subject
+    '''
+
+    if manifest.endswith('json'):
+        with open(manifest) as f:
+            subjects = json.load(f)
+    else:
+        with open(manifest) as f:
+            subjects = [dict(row) for row in csv.DictReader(f)]
+
+    root = os.path.dirname(os.path.abspath(manifest))
+    for subject in subjects:
+        for key in ('subject', 'gwb_prob', 'cgb_prob'):
+            if not subject.get(key):
+                raise ValueError('Manifest entry %s has no %s' %
+                                 (subject, key))
+        for key in ('gwb_prob', 'cgb_prob', 'intensity', 'out_dir'):
+            if subject.get(key):
+                subject[key] = os.path.join(root, subject[key])
+        if not subject.get('out_dir'):
+            subject['out_dir'] = os.path.dirname(subject['gwb_prob'])
+    return subjects
+
+
+def subject_outputs(subject):
+
+    '''
+    Files written for one subject, grouped by stage.
+    '''
+
+    base = os.path.join(subject['out_dir'], subject['subject'])
+    outputs = {'gwb_levelset': [base + '_gwb_levelset.nii.gz'],
+               'cgb_levelset': [base + '_cgb_levelset.nii.gz'],
+               'layering': [base + '_depth.nii.gz', base + '_layers.nii.gz',
+                            base + '_boundaries.nii.gz']}
+    if subject.get('intensity'):
+        outputs['profile_sampling'] = [base + '_profiles.nii.gz']
+    return outputs
+
+
+def run_subject(subject, n_layers=10, backend='cbstools', crop=False):
+
+    '''
+    Runs create_levelsets, layering and (if an intensity image is given)
+    profile_sampling for one subject. Stages whose outputs exist already are
+    not run again.
+
+        Parameters
+        -----------
+        subject : Dictionary as returned by "read_manifest"
+        n_layers : int, number of layers to be created (default is 10)
+        backend : Backend for create_levelsets, layering and
+            profile_sampling (default is 'cbstools')
+        crop : Whether to crop to the cortex before layering (default is
+            'False')
+
+        Returns
+        -------
+        Status dictionary with the subject, the status ('done', 'skipped' or
+        'failed'), the stages that were run, the error if any and the run
+        time in seconds. It is also written to <out_dir>/<subject>_status.json
+    '''
+
+    start = time.time()
+    base = os.path.join(subject['out_dir'], subject['subject'])
+    outputs = subject_outputs(subject)
+    done = dict((stage, all(os.path.isfile(f) for f in files))
+                for stage, files in outputs.items())
+    status = {'subject': subject['subject'], 'stages': [], 'error': None}
+
+    try:
+        if not os.path.isdir(subject['out_dir']):
+            os.makedirs(subject['out_dir'])
+
+        for surface in ('gwb', 'cgb'):
+            if not done[surface + '_levelset']:
+                create_levelsets(subject[surface + '_prob'],
+                                 base_name=base + '_' + surface,
+                                 backend=backend)
+                status['stages'].append(surface + '_levelset')
+        # later stages read the files, which may be written in the background
+        wait_for_writes()
+
+        if not done['layering']:
+            layering(outputs['gwb_levelset'][0], outputs['cgb_levelset'][0],
+                     n_layers=n_layers, base_name=base, backend=backend,
+                     crop=crop)
+            status['stages'].append('layering')
+        wait_for_writes()
+
+        if 'profile_sampling' in outputs and not done['profile_sampling']:
+            profile_sampling(outputs['layering'][2], subject['intensity'],
+                             base_name=base, backend=backend)
+            status['stages'].append('profile_sampling')
+        wait_for_writes()
+
+        status['status'] = 'done' if status['stages'] else 'skipped'
+        status['seconds'] = time.time() - start
+        _write_status(subject, status)
+    except Exception:
+        status['status'] = 'failed'
+        status['error'] = traceback.format_exc()
+        status['seconds'] = time.time() - start
+        try:
+            _write_status(subject, status)
+        except (IOError, OSError):
+            # the error is reported in the returned status
+            pass
+    return status
+
+
+def _write_status(subject, status):
+    fname = os.path.join(subject['out_dir'], subject['subject'] +
+                         '_status.json')
+    with open(fname, 'w') as f:
+        json.dump(status, f, indent=2)
+
+
+def available_memory():
+
+    '''
+    Memory available for new processes in MB, read from /proc/meminfo.
+    Returns None if it cannot be determined.
+    '''
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def worker_memory(subjects, n_layers=10, backend='cbstools'):
+
+    '''
+    Estimates the memory one worker needs for the largest subject, i.e. the
+    arrays held in Python during layering plus the Java heap (if used).
+
+        Returns
+        -------
+        Tuple of the total memory in MB and the Java heap size string (None
+        for the 'numpy' backend). If no input can be read, the memory is 0
+        and the heap size is left at its default.
+    '''
+
+    shapes = []
+    for subject in subjects:
+        try:
+            shapes.append(load_volume(subject['gwb_prob']).shape)
+        except Exception:
+            # the subject will fail with its own error when it is run
+            pass
+    if not shapes:
+        return 0., None
+    shape = max(shapes, key=lambda shape: np.prod(shape[:3]))
+    python_mb = 4. * np.prod(shape[:3]) * (n_layers + 8) / 2 ** 20
+    if backend == 'numpy':
+        return python_mb, None
+    heap = estimate_heap(shape, n_layers)
+    return python_mb + float(heap[:-1]), heap
+
+
+def _subject_process(index, subject, n_layers, backend, crop, maxheap,
+                     queue):
+    # runs one subject in its own process, which starts its own JVM on
+    # first use, sized for the cohort
+    configure_vm(maxheap=maxheap)
+    queue.put((index, run_subject(subject, n_layers, backend, crop)))
+
+
+def _failed_status(subject, error, seconds):
+    # status of a subject whose process died or timed out, written to its
+    # status file if possible
+    status = {'subject': subject['subject'], 'stages': [], 'error': error,
+              'status': 'failed', 'seconds': seconds}
+    try:
+        _write_status(subject, status)
+    except (IOError, OSError):
+        pass
+    return status
+
+
+def run_batch(manifest, n_workers=None, n_layers=10, backend='cbstools',
+              crop=False, memory_limit=None, summary_file=None, timeout=None):
+
+    '''
+    Runs the layering pipeline for all subjects of a manifest in at most
+    n_workers processes at a time, one per subject with its own JVM. A
+    subject whose process dies (e.g. killed for lack of memory) or times out
+    is reported as failed and the others continue.
+
+        Parameters
+        -----------
+        manifest : Path to the manifest, see "read_manifest"
+        n_workers : Maximum number of worker processes. Default is the number
+            of CPUs.
+        n_layers : int, number of layers to be created (default is 10)
+        backend : Backend for create_levelsets and layering, 'cbstools'
+            (default) or 'numpy'
+        crop : Whether to crop to the cortex before layering (default is
+            'False')
+        memory_limit : Memory in MB the workers may use together. Default is
+            the memory currently available. The number of workers is reduced
+            so that the estimated memory of all workers fits.
+        summary_file : Path of a JSON file to write the status of all subjects
+            to. Default is 'batch_status.json' next to the manifest.
+        timeout : Seconds after which the process of a subject is terminated
+            and the subject reported as failed (default is no limit)
+
+        Returns
+        -------
+        List of status dictionaries, one per subject (see "run_subject")
+    '''
+
+    subjects = read_manifest(manifest)
+    if not subjects:
+        return []
+
+    per_worker, maxheap = worker_memory(subjects, n_layers, backend)
+    if memory_limit is None:
+        memory_limit = available_memory()
+    n_workers = n_workers or multiprocessing.cpu_count()
+    if memory_limit is not None and per_worker > 0:
+        n_workers = min(n_workers, int(memory_limit // per_worker))
+    n_workers = max(min(n_workers, len(subjects)), 1)
+    print("Processing %i subjects with %i workers (%.0f MB each)" %
+          (len(subjects), n_workers, per_worker))
+
+    queue = multiprocessing.Queue()
+    statuses = [None] * len(subjects)
+    waiting = list(range(len(subjects)))
+    running = {}
+    while waiting or running:
+        while waiting and len(running) < n_workers:
+            index = waiting.pop(0)
+            process = multiprocessing.Process(
+                target=_subject_process,
+                args=(index, subjects[index], n_layers, backend, crop,
+                      maxheap, queue))
+            process.start()
+            running[index] = (process, time.time())
+
+        try:
+            index, status = queue.get(timeout=POLL_INTERVAL)
+            statuses[index] = status
+            running.pop(index)[0].join()
+            continue
+        except Empty:
+            pass
+
+        for index, (process, start) in list(running.items()):
+            seconds = time.time() - start
+            if not process.is_alive():
+                # collect results sent just before the processes exited
+                try:
+                    while True:
+                        done, status = queue.get(timeout=POLL_INTERVAL)
+                        statuses[done] = status
+                        running.pop(done)[0].join()
+                except Empty:
+                    pass
+                if index in running:
+                    running.pop(index)
+                    statuses[index] = _failed_status(
+                        subjects[index], 'process exited with code %s' %
+                        process.exitcode, seconds)
+            elif timeout is not None and seconds > timeout:
+                process.terminate()
+                process.join()
+                running.pop(index)
+                statuses[index] = _failed_status(
+                    subjects[index], 'timed out after %g s' % timeout,
+                    seconds)
+
+    if summary_file is None:
+        summary_file = os.path.join(os.path.dirname(os.path.abspath(manifest)),
+                                    'batch_status.json')
+    with open(summary_file, 'w') as f:
+        json.dump(statuses, f, indent=2)
+    for status in statuses:
+        print("%s: %s" % (status['subject'], status['status']))
+    return statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run levelset creation, equivolumetric layering and '
+                    'profile sampling for all subjects in a manifest.')
+    parser.add_argument('manifest',
+                        help='CSV or JSON file with the columns subject, '
+                             'gwb_prob, cgb_prob and optionally intensity '
+                             'and out_dir')
+    parser.add_argument('-j', '--n_workers', type=int, default=None,
+                        help='maximum number of worker processes '
+                             '(default: number of CPUs)')
+    parser.add_argument('-n', '--n_layers', type=int, default=10,
+                        help='number of layers (default: 10)')
+    parser.add_argument('--backend', choices=['cbstools', 'numpy'],
+                        default='cbstools',
+                        help='backend for levelsets and layering '
+                             '(default: cbstools)')
+    parser.add_argument('--crop', action='store_true',
+                        help='crop to the cortex before layering')
+    parser.add_argument('--memory_limit', type=float, default=None,
+                        help='memory in MB all workers may use together '
+                             '(default: memory available)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which a subject is reported as '
+                             'failed (default: no limit)')
+    parser.add_argument('--summary', default=None,
+                        help='JSON file for the status of all subjects')
+    args = parser.parse_args(argv)
+
+    statuses = run_batch(args.manifest, n_workers=args.n_workers,
+                         n_layers=args.n_layers, backend=args.backend,
+                         crop=args.crop, memory_limit=args.memory_limit,
+                         summary_file=args.summary, timeout=args.timeout)
+    return int(any(s['status'] == 'failed' for s in statuses))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
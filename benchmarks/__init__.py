@@ -0,0 +1,2 @@
+from .phantoms import sphere_phantom, folded_phantom, sphere_mesh
+from .run_benchmarks import run_benchmarks, compare_results
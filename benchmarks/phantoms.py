@@ -0,0 +1,142 @@
+import numpy as np
+import nibabel as nb
+
+
+def _grid(shape, voxel_size):
+    # coordinates in mm of all voxels relative to the centre of the volume,
+    # and the centre in mm from the first voxel (the space of CBS meshes)
+    shape = (shape,) * 3 if np.isscalar(shape) else tuple(shape)
+    voxel_size = np.broadcast_to(voxel_size, (3,)).astype(float)
+    centre = (np.asarray(shape) - 1) / 2. * voxel_size
+    axes = [np.arange(n) * z - c for n, z, c in zip(shape, voxel_size, centre)]
+    return np.meshgrid(*axes, indexing='ij'), centre, voxel_size
+
+
+def _image(data, voxel_size):
+    img = nb.Nifti1Image(np.asfortranarray(data, dtype=np.float32),
+                         np.diag(list(voxel_size) + [1]))
+    img.header.set_xyzt_units('mm')
+    return img
+
+
+def sphere_phantom(shape=64, voxel_size=1., thickness=None):
+
+    '''
+    Two concentric spheres bounding a cortical shell, for which the
+    equivolumetric depth is known in closed form: the volume between the
+    inner sphere and a sphere of radius r is the fraction
+    (r**3 - r_in**3) / (r_out**3 - r_in**3) of the whole shell.
+
+        Parameters
+        -----------
+        shape : Number of voxels along each axis (int or sequence of three)
+        voxel_size : Voxel size in mm (float or sequence of three)
+        thickness : Thickness of the shell in mm. Default is an eighth of the
+            smallest field of view, with the inner radius twice as large.
+
+        Returns
+        -------
+        Dictionary with Nibabel images 'gwb_prob' and 'cgb_prob' (binary
+        tissue classifications inside the GM/WM and CSF/GM surface),
+        'gwb_levelset' and 'cgb_levelset' (exact signed distances in mm),
+        'depth' (exact equivolumetric depth, 0 in WM and 1 in CSF) and
+        'intensity' (4D image of 3 volumes varying linearly with depth), and
+        the entries 'centre' (centre in mm from the first voxel), 'r_in' and
+        'r_out'.
+    '''
+
+    (x, y, z), centre, voxel_size = _grid(shape, voxel_size)
+    fov = min(np.asarray(x.shape) * voxel_size)
+    if thickness is None:
+        thickness = fov / 8.
+    r_in = 2 * thickness
+    r_out = r_in + thickness
+    r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+
+    depth = (r ** 3 - r_in ** 3) / (r_out ** 3 - r_in ** 3)
+    depth = np.clip(depth, 0, 1)
+    intensity = np.stack([depth * (i + 1) + i for i in range(3)], axis=-1)
+    return {'gwb_prob': _image(r <= r_in, voxel_size),
+            'cgb_prob': _image(r <= r_out, voxel_size),
+            'gwb_levelset': _image(r - r_in, voxel_size),
+            'cgb_levelset': _image(r - r_out, voxel_size),
+            'depth': _image(depth, voxel_size),
+            'intensity': _image(intensity, voxel_size),
+            'centre': centre, 'r_in': r_in, 'r_out': r_out}
+
+
+def folded_phantom(shape=64, voxel_size=1., thickness=None, n_folds=4,
+                   amplitude=0.2):
+
+    '''
+    Cortical shell whose surfaces are folded like gyri and sulci, by
+    modulating the radius of two concentric spheres with the same pattern.
+    There is no closed form for its equivolumetric depth, it measures how
+    the stages scale with realistic curvature.
+
+        Parameters
+        -----------
+        shape, voxel_size, thickness : see "sphere_phantom"
+        n_folds : Number of folds along each angular direction
+        amplitude : Depth of the folds relative to the inner radius
+
+        Returns
+        -------
+        Dictionary with the entries of "sphere_phantom" except for the
+        levelsets and the depth, which have to be computed with
+        "create_levelsets" and "layering".
+    '''
+
+    (x, y, z), centre, voxel_size = _grid(shape, voxel_size)
+    fov = min(np.asarray(x.shape) * voxel_size)
+    if thickness is None:
+        thickness = fov / 10.
+    r_in = 2 * thickness
+    r_out = r_in + thickness
+    r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+    theta = np.arccos(np.clip(z / np.maximum(r, 1e-6), -1, 1))
+    phi = np.arctan2(y, x)
+    fold = 1 + amplitude * np.sin(n_folds * theta) * np.cos(n_folds * phi)
+
+    # a rough depth for the intensity, the folds thin the shell slightly
+    depth = np.clip((r / fold - r_in) / thickness, 0, 1)
+    intensity = np.stack([depth * (i + 1) + i for i in range(3)], axis=-1)
+    return {'gwb_prob': _image(r <= r_in * fold, voxel_size),
+            'cgb_prob': _image(r <= r_out * fold, voxel_size),
+            'intensity': _image(intensity, voxel_size),
+            'centre': centre, 'r_in': r_in, 'r_out': r_out}
+
+
+def sphere_mesh(radius, centre=(0, 0, 0), n_vertices=10000):
+
+    '''
+    Triangulated sphere with about n_vertices vertices on a latitude and
+    longitude grid, e.g. a mid-cortical surface of "sphere_phantom" with
+    radius (r_in + r_out) / 2 and its centre.
+
+        Returns
+        -------
+        Dictionary with 'coords' (n_vertices, 3) and 'faces' (n_faces, 3)
+    '''
+
+    n_lat = max(int(np.sqrt(n_vertices / 2.)), 2)
+    n_lon = 2 * n_lat
+    theta = np.linspace(0, np.pi, n_lat + 2)[1:-1]
+    phi = np.linspace(0, 2 * np.pi, n_lon, endpoint=False)
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+    ring = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi),
+                     np.cos(theta)], axis=-1).reshape(-1, 3)
+    coords = np.vstack([[0, 0, 1], ring, [0, 0, -1]]) * radius + centre
+
+    # quads between neighbouring rings split into two triangles, and fans
+    # around the poles
+    idx = np.arange(n_lat * n_lon).reshape(n_lat, n_lon) + 1
+    right = np.roll(idx, -1, axis=1)
+    quads = [idx[:-1], right[:-1], right[1:], idx[1:]]
+    faces = [np.stack([quads[0], quads[1], quads[2]], -1).reshape(-1, 3),
+             np.stack([quads[0], quads[2], quads[3]], -1).reshape(-1, 3),
+             np.stack([np.zeros(n_lon, int), right[0], idx[0]], -1),
+             np.stack([np.full(n_lon, len(coords) - 1), idx[-1], right[-1]],
+                      -1)]
+    return {'coords': coords.astype(np.float32),
+            'faces': np.vstack(faces).astype(np.int32)}
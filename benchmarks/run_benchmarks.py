@@ -0,0 +1,522 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+import numpy as np
+import scipy
+import nibabel as nb
+from .. import jvm
+from ..io_mesh import load_mesh_geometry, save_mesh_geometry, \
+    load_layered_mesh, save_layered_mesh
+from ..io_volume import load_volume, save_volume
+from ..mesh_layers import sampling_weights, sample_volume
+from ..volumetric_layering import create_levelsets, layering, \
+    profile_sampling, profile_meshing, _backend_version
+from .phantoms import sphere_phantom, folded_phantom, sphere_mesh
+
+
+PHANTOMS = {'sphere': sphere_phantom, 'folded': folded_phantom}
+
+# benchmarks run once per backend, the others do not depend on it
+STAGES = ['create_levelsets', 'layering', 'profile_sampling',
+          'profile_meshing', 'create_levelsets_slabs', 'layering_slabs']
+MESH_FORMATS = ['vtk', 'vtk_binary', 'ply', 'ply_binary', 'obj', 'gii',
+                'layered_npz']
+BENCHMARKS = STAGES + ['write_' + f for f in MESH_FORMATS] + \
+    ['read_' + f for f in MESH_FORMATS] + ['sampling_weights',
+                                           'sample_volume']
+
+# seconds between checks whether a benchmark process is still alive
+POLL_INTERVAL = 1.
+
+
+def prepare_case(phantom, shape, voxel_size, directory, n_layers=10,
+                 mesh_vertices=100000):
+
+    '''
+    Writes the inputs of all benchmarks for one phantom to a directory.
+    Levelsets and boundaries of folded phantoms are computed with the
+    'numpy' backend.
+
+        Returns
+        -------
+        Dictionary with the filenames of the inputs and, for spheres, of the
+        exact levelsets and depth, and the radii of the shell
+    '''
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    data = PHANTOMS[phantom](shape, voxel_size)
+    case = {'phantom': phantom, 'shape': list(data['gwb_prob'].shape),
+            'voxel_size': float(np.min(data['gwb_prob'].header.get_zooms())),
+            'n_layers': n_layers, 'r_in': data['r_in'],
+            'r_out': data['r_out'], 'directory': directory}
+    names = [name for name in ('gwb_prob', 'cgb_prob', 'gwb_levelset',
+                               'cgb_levelset', 'depth', 'intensity')
+             if name in data]
+    for name in names:
+        case[name] = os.path.join(directory, name + '.nii.gz')
+        save_volume(case[name], data[name], background=False)
+    if phantom == 'sphere':
+        case['exact'] = True
+    else:
+        case['exact'] = False
+        for surface in ('gwb', 'cgb'):
+            create_levelsets(case[surface + '_prob'], backend='numpy',
+                             base_name=os.path.join(directory, surface))
+            case[surface + '_levelset'] = os.path.join(
+                directory, surface + '_levelset.nii.gz')
+    layering(case['gwb_levelset'], case['cgb_levelset'], n_layers=n_layers,
+             backend='numpy', base_name=os.path.join(directory, 'prepared'))
+    case['boundaries'] = os.path.join(directory,
+                                      'prepared_boundaries.nii.gz')
+
+    # mid-cortical surface for profile_meshing and a larger one for the
+    # mesh readers, writers and samplers
+    radius = (data['r_in'] + data['r_out']) / 2.
+    case['mesh'] = os.path.join(directory, 'mesh.vtk')
+    save_mesh_geometry(case['mesh'], sphere_mesh(radius, data['centre'],
+                                                 10000), binary=True)
+    case['io_mesh'] = os.path.join(directory, 'io_mesh.npz')
+    np.savez(case['io_mesh'], **sphere_mesh(radius, data['centre'],
+                                           mesh_vertices))
+    return case
+
+
+def _depth_errors(depth, case):
+    # error of the depth in the cortex against the exact sphere depth
+    exact = load_volume(case['depth']).get_data()
+    cortex = (exact > 0) & (exact < 1)
+    error = np.abs(depth.get_data()[cortex] - exact[cortex])
+    return {'depth_mean_error': float(error.mean()),
+            'depth_max_error': float(error.max())}
+
+
+def _slab_differences(stitched, full, names):
+    # differences of outputs stitched from slabs against a full-volume run
+    result = {}
+    for name, a, b in zip(names, stitched, full):
+        a, b = a.get_data(), b.get_data()
+        if name == 'layers':
+            result['slab_layers_changed'] = int(np.count_nonzero(a != b))
+        else:
+            result['slab_%s_max_diff' % name] = float(np.abs(a - b).max())
+    return result
+
+
+def _setup(name, case, backend):
+    # prepares the inputs of a benchmark outside of the timing and returns
+    # a function that runs it once and returns a dictionary of accuracy
+    # measures
+    n_layers = case['n_layers']
+    mesh = dict(np.load(case['io_mesh']))
+    fmt = name.split('_', 1)[1] if '_' in name else None
+
+    if name == 'create_levelsets':
+        def run():
+            levelset = create_levelsets(case['gwb_prob'], save_data=False,
+                                        backend=backend)
+            if not case['exact']:
+                return {}
+            # accuracy within the thickness of the shell around the surface
+            exact = load_volume(case['gwb_levelset']).get_data()
+            band = np.abs(exact) < case['r_out'] - case['r_in']
+            error = np.abs(levelset.get_data()[band] - exact[band])
+            return {'levelset_mean_error': float(error.mean()),
+                    'levelset_max_error': float(error.max())}
+
+    elif name == 'layering':
+        def run():
+            depth = layering(case['gwb_levelset'], case['cgb_levelset'],
+                             n_layers=n_layers, save_data=False,
+                             backend=backend)[0]
+            return _depth_errors(depth, case) if case['exact'] else {}
+
+    elif name in ('create_levelsets_slabs', 'layering_slabs'):
+        # four slabs stitched together, compared with a full-volume run
+        slab_size = int(np.ceil(case['shape'][2] / 4.))
+        base_name = os.path.join(case['directory'], 'slabs_%s' % backend)
+        if name == 'create_levelsets_slabs':
+            slab_halo = 5.
+            full = create_levelsets(case['gwb_prob'], save_data=False,
+                                    backend=backend).get_data()
+
+            def run():
+                stitched = create_levelsets(
+                    case['gwb_prob'], base_name=base_name, backend=backend,
+                    slab_size=slab_size, slab_halo=slab_halo).get_data()
+                # exact within the halo, clipped to it beyond
+                diff = np.abs(stitched - np.clip(full, -slab_halo, slab_halo))
+                halo = np.abs(full) <= slab_halo
+                return {'slab_levelset_max_diff_in_halo':
+                            float(diff[halo].max()),
+                        'slab_levelset_max_diff_clipped': float(diff.max())}
+        else:
+            # a halo of one and a half cortical thicknesses
+            slab_halo = 1.5 * (case['r_out'] - case['r_in'])
+            full = layering(case['gwb_levelset'], case['cgb_levelset'],
+                            n_layers=n_layers, save_data=False,
+                            backend=backend)
+
+            def run():
+                stitched = layering(case['gwb_levelset'],
+                                    case['cgb_levelset'], n_layers=n_layers,
+                                    base_name=base_name, backend=backend,
+                                    slab_size=slab_size, slab_halo=slab_halo)
+                return _slab_differences(stitched, full, ('depth', 'layers',
+                                                          'boundaries'))
+
+    elif name == 'profile_sampling':
+        def run():
+            profile_sampling(case['boundaries'], case['intensity'],
+                             save_data=False, backend=backend)
+            return {}
+
+    elif name == 'profile_meshing':
+        def run():
+            meshes = profile_meshing(case['boundaries'], case['mesh'],
+                                     save_data=False, backend=backend)
+            if not case['exact']:
+                return {}
+            # distance of the vertices to the exact equivolumetric spheres
+            centre = load_mesh_geometry(case['mesh'])['coords'].mean(axis=0)
+            r_in, r_out = case['r_in'], case['r_out']
+            errors = []
+            for i, layer in enumerate(meshes):
+                radius = (r_in ** 3 + float(i) / (len(meshes) - 1) *
+                          (r_out ** 3 - r_in ** 3)) ** (1 / 3.)
+                r = np.sqrt(((layer['coords'] - centre) ** 2).sum(axis=1))
+                errors.append(np.abs(r - radius))
+            errors = np.concatenate(errors)
+            return {'radius_mean_error': float(errors.mean()),
+                    'radius_max_error': float(errors.max())}
+
+    elif name.startswith('write_') or name.startswith('read_'):
+        layered = fmt == 'layered_npz'
+        binary = fmt.endswith('_binary')
+        fname = os.path.join(case['directory'], 'io_%s.%s' %
+                             (fmt, 'npz' if layered else fmt.split('_')[0]))
+        if layered:
+            # a stack of n_layers + 1 surfaces sharing the triangles
+            scales = np.linspace(0.9, 1.1, n_layers + 1)[:, None, None]
+            surfaces = {'coords': mesh['coords'][None] * scales,
+                        'faces': mesh['faces']}
+            write = lambda: save_layered_mesh(fname, surfaces)
+            read = lambda: load_layered_mesh(fname)
+        else:
+            write = lambda: save_mesh_geometry(fname, mesh, binary=binary)
+            read = lambda: load_mesh_geometry(fname)
+        if name.startswith('read_'):
+            write()
+
+        def run():
+            (write if name.startswith('write_') else read)()
+            return {'file_mb': os.path.getsize(fname) / 2. ** 20}
+
+    elif name in ('sampling_weights', 'sample_volume'):
+        img = load_volume(case['intensity'])
+        affine = np.diag(list(img.header.get_zooms()[:3]) + [1])
+        weights = sampling_weights(mesh['coords'], affine, img.shape)
+
+        def run():
+            if name == 'sampling_weights':
+                sampling_weights(mesh['coords'], affine, img.shape)
+            else:
+                sample_volume(img, mesh['coords'], weights=weights)
+            return {}
+
+    else:
+        raise ValueError('unknown benchmark %s' % name)
+    return run
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2. ** 20
+    except (IOError, OSError):
+        return None
+
+
+def _measure(name, case, backend, repeat, queue):
+    # runs in a fresh process, so that the peak memory belongs to this
+    # benchmark alone
+    try:
+        result = {}
+        if backend == 'cbstools' and name in STAGES:
+            # the start of the JVM is measured separately
+            start = time.time()
+            jvm.start_vm(case['shape'], case['n_layers'])
+            result['jvm_start_seconds'] = time.time() - start
+        run = _setup(name, case, backend)
+        result['rss_before_mb'] = _rss_mb()
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            result.update(run())
+            times.append(time.time() - start)
+        result['seconds'] = min(times)
+        result['all_seconds'] = times
+        result['peak_rss_mb'] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        queue.put(result)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def run_benchmark(name, case, backend=None, repeat=1, timeout=None):
+
+    '''
+    Runs one benchmark in a separate process.
+
+        Parameters
+        -----------
+        name : Name of the benchmark, one of BENCHMARKS
+        case : Inputs as returned by "prepare_case"
+        backend : 'cbstools' or 'numpy' for the stages in STAGES, ignored by
+            the others
+        repeat : Number of runs, the fastest is reported
+        timeout : Seconds after which the process is terminated and the
+            benchmark reported as failed (default is no limit)
+
+        Returns
+        -------
+        Dictionary with the benchmark, backend, phantom, shape and voxel size,
+        the run time in seconds ('seconds' for the fastest run and
+        'all_seconds'), the resident memory before the first run and the
+        peak resident memory of the process in MB, accuracy measures against
+        the exact solution for spheres, and 'error' if it failed, also when
+        the process died (e.g. killed for lack of memory) or timed out
+    '''
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure,
+                                      args=(name, case, backend, repeat,
+                                            queue))
+    process.start()
+    start = time.time()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            if not process.is_alive():
+                # the result may have been sent just before the exit
+                try:
+                    result = queue.get(timeout=POLL_INTERVAL)
+                except Empty:
+                    result = {'error': 'process exited with code %s' %
+                              process.exitcode}
+            elif timeout is not None and time.time() - start > timeout:
+                process.terminate()
+                result = {'error': 'timed out after %g s' % timeout}
+    process.join()
+    result.update({'benchmark': name,
+                   'backend': backend if name in STAGES else None,
+                   'phantom': case['phantom'], 'shape': case['shape'],
+                   'voxel_size': case['voxel_size']})
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(backends):
+
+    '''
+    Versions and settings the results depend on: git commit, Python, NumPy,
+    SciPy and Nibabel versions, backend versions, JVM options, CPU count and
+    platform.
+    '''
+
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'nibabel': nb.__version__,
+            'backends': dict((b, _backend_version(b)) for b in backends),
+            'jvm': dict(jvm._config),
+            'cpu_count': multiprocessing.cpu_count(),
+            'platform': platform.platform()}
+
+
+def run_benchmarks(phantoms=('sphere',), sizes=(64,), voxel_sizes=(1.,),
+                   backends=('numpy',), benchmarks=None, repeat=1,
+                   n_layers=10, mesh_vertices=100000, output=None,
+                   directory=None, verbose=True, timeout=None):
+
+    '''
+    Runs the benchmarks for all combinations of phantoms, grid sizes, voxel
+    sizes and backends.
+
+        Parameters
+        -----------
+        phantoms : Names of phantoms, 'sphere' and/or 'folded'
+        sizes : Numbers of voxels along each axis
+        voxel_sizes : Voxel sizes in mm
+        backends : Backends of the pipeline stages, 'numpy' and/or
+            'cbstools'
+        benchmarks : Names of the benchmarks to run (default is all, see
+            BENCHMARKS)
+        repeat : Number of runs of each benchmark, the fastest is reported
+        n_layers : Number of layers
+        mesh_vertices : Number of vertices of the mesh for the mesh readers,
+            writers and samplers
+        output : JSON file to write the results to
+        directory : Directory for the inputs and outputs, default is a
+            temporary directory that is removed afterwards
+        timeout : Seconds after which a benchmark is reported as failed
+            (default is no limit)
+
+        Returns
+        -------
+        Dictionary with 'metadata' (see "metadata") and 'results', a list of
+        dictionaries as returned by "run_benchmark"
+    '''
+
+    benchmarks = benchmarks or BENCHMARKS
+    cleanup = directory is None
+    directory = directory or tempfile.mkdtemp(prefix='laminar_benchmarks_')
+    report = {'metadata': metadata(backends), 'results': []}
+    try:
+        for phantom in phantoms:
+            for size in sizes:
+                for voxel_size in voxel_sizes:
+                    case = prepare_case(
+                        phantom, size, voxel_size,
+                        os.path.join(directory, '%s_%i_%g' %
+                                     (phantom, size, voxel_size)),
+                        n_layers, mesh_vertices)
+                    for name in benchmarks:
+                        for backend in (backends if name in STAGES
+                                        else [None]):
+                            result = run_benchmark(name, case, backend,
+                                                   repeat, timeout)
+                            report['results'].append(result)
+                            if verbose:
+                                _print_result(result)
+    finally:
+        if cleanup:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def _key(result):
+    return (result['benchmark'], result['backend'], result['phantom'],
+            tuple(result['shape']), result['voxel_size'])
+
+
+def _print_result(result):
+    name = '%s %s %s %s %gmm' % (result['benchmark'], result['backend'] or '',
+                                 result['phantom'],
+                                 'x'.join(map(str, result['shape'])),
+                                 result['voxel_size'])
+    if 'error' in result:
+        print('%-50s failed\n%s' % (name, result['error']))
+    else:
+        print('%-50s %8.3f s %8.0f MB peak' % (name, result['seconds'],
+                                               result['peak_rss_mb']))
+
+
+def compare_results(baseline, results):
+
+    '''
+    Compares the run times of two benchmark reports, e.g. of two commits or
+    of two backends written to different files.
+
+        Parameters
+        -----------
+        baseline, results : Reports as returned by "run_benchmarks" or the
+            JSON files they were written to
+
+        Returns
+        -------
+        List of tuples (benchmark, backend, phantom, shape, voxel size,
+        baseline seconds, seconds, ratio) for the benchmarks in both reports,
+        a ratio below 1 means faster than the baseline
+    '''
+
+    reports = []
+    for report in (baseline, results):
+        if not isinstance(report, dict):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append(dict((_key(r), r) for r in report['results']
+                            if 'error' not in r))
+    comparison = []
+    for key in sorted(set(reports[0]) & set(reports[1])):
+        old, new = reports[0][key]['seconds'], reports[1][key]['seconds']
+        comparison.append(key + (old, new, new / old if old else None))
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time and memory-profile the pipeline stages, mesh '
+                    'readers and writers and samplers on synthetic '
+                    'cortical phantoms.')
+    parser.add_argument('-o', '--output', default='benchmarks.json',
+                        help='JSON file for the results '
+                             '(default: benchmarks.json)')
+    parser.add_argument('--phantoms', nargs='+', default=['sphere'],
+                        choices=sorted(PHANTOMS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[64],
+                        help='voxels along each axis (default: 64)')
+    parser.add_argument('--voxel_sizes', nargs='+', type=float, default=[1.],
+                        help='voxel sizes in mm (default: 1)')
+    parser.add_argument('--backends', nargs='+', default=['numpy'],
+                        choices=['cbstools', 'numpy'])
+    parser.add_argument('--benchmarks', nargs='+', default=None,
+                        choices=BENCHMARKS, help='default: all')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--n_layers', type=int, default=10)
+    parser.add_argument('--mesh_vertices', type=int, default=100000)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which a benchmark is reported as '
+                             'failed (default: no limit)')
+    parser.add_argument('--maxheap', default=None,
+                        help='maximum Java heap size, e.g. 4g')
+    parser.add_argument('--compare', default=None,
+                        help='JSON file of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    if args.maxheap:
+        jvm.configure_vm(maxheap=args.maxheap)
+    report = run_benchmarks(args.phantoms, args.sizes, args.voxel_sizes,
+                            args.backends, args.benchmarks, args.repeat,
+                            args.n_layers, args.mesh_vertices, args.output,
+                            timeout=args.timeout)
+    if args.compare:
+        for row in compare_results(args.compare, report):
+            print('%-18s %-8s %-6s %-12s %4gmm %8.3f s -> %8.3f s (x%.2f)' %
+                  (row[0], row[1] or '', row[2], 'x'.join(map(str, row[3])),
+                   row[4], row[5], row[6], row[7] or 0))
+    return int(any('error' in r for r in report['results']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
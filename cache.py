@@ -0,0 +1,164 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nb
+
+
+# the cache is disabled until a directory is set with "configure_cache"
+_config = {'directory': None, 'max_size': 10 * 2 ** 30}
+
+# content hashes of lookup table directories, keyed by path and mtime
+_dir_hashes = {}
+
+
+def configure_cache(directory, max_size=10 * 2 ** 30):
+
+    '''
+    Enables the on-disk cache for the results of "create_levelsets" and
+    "layering". Results are stored under a hash of the input data, affine,
+    voxel sizes, parameters and backend version, and returned from the
+    cache on later calls with the same inputs, without starting the JVM.
+
+        Parameters
+        -----------
+        directory : Directory to store the cached results in, None to disable
+            the cache
+        max_size : Maximum size of the cache in bytes (default is 10 GB). The
+            least recently used results are removed when it is exceeded.
+    '''
+
+    if directory is not None and not os.path.isdir(directory):
+        os.makedirs(directory)
+    _config['directory'] = directory
+    _config['max_size'] = max_size
+
+
+def cache_enabled():
+    return _config['directory'] is not None
+
+
+def directory_hash(path):
+
+    '''
+    Hash of the names and contents of all files in a directory, e.g. the
+    topology lookup tables. Computed once per directory modification time.
+    '''
+
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path))
+    if key not in _dir_hashes:
+        sha = hashlib.sha1()
+        for name in sorted(os.listdir(path)):
+            fname = os.path.join(path, name)
+            if os.path.isfile(fname):
+                sha.update(name.encode('utf-8'))
+                with open(fname, 'rb') as f:
+                    for block in iter(lambda: f.read(2 ** 20), b''):
+                        sha.update(block)
+        _dir_hashes[key] = sha.hexdigest()
+    return _dir_hashes[key]
+
+
+def cache_key(arrays, affine, zooms, **params):
+
+    '''
+    Hash identifying a cached result.
+
+        Parameters
+        -----------
+        arrays : List of input numpy arrays, hashed with dtype and shape
+        affine : Affine of the inputs
+        zooms : Voxel sizes of the inputs
+        params : Any further parameters that change the result (e.g.
+            n_layers, backend version), converted to strings
+
+        Returns
+        -------
+        Hexadecimal hash string
+    '''
+
+    sha = hashlib.sha1()
+    for data in arrays:
+        data = np.asarray(data)
+        sha.update(('%s %s' % (data.dtype.str, data.shape)).encode('utf-8'))
+        # hash the memory as laid out, views are contiguous for C and F order
+        if not (data.flags.c_contiguous or data.flags.f_contiguous):
+            data = np.ascontiguousarray(data)
+        sha.update(np.ravel(data, order='K').view(np.uint8).data)
+    sha.update(np.asarray(affine, dtype=np.float64).tobytes())
+    sha.update(np.asarray(zooms, dtype=np.float64).tobytes())
+    for name in sorted(params):
+        sha.update(('%s=%r;' % (name, params[name])).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def load_cached(key, names):
+
+    '''
+    Returns the cached images for a key as a list in the order of names, or
+    None if they are not in the cache. A hit marks the entry as recently
+    used.
+    '''
+
+    if not cache_enabled():
+        return None
+    entry = os.path.join(_config['directory'], key)
+    fnames = [os.path.join(entry, name + '.nii') for name in names]
+    if not all(os.path.isfile(f) for f in fnames):
+        return None
+    os.utime(entry, None)
+    return [nb.load(f) for f in fnames]
+
+
+def store_cached(key, names, imgs):
+
+    '''
+    Stores images in the cache under a key and evicts the least recently
+    used entries if the cache grows beyond its maximum size. Images are
+    stored uncompressed so that they can be memory-mapped when loaded.
+    '''
+
+    if not cache_enabled():
+        return
+    directory = _config['directory']
+    entry = os.path.join(directory, key)
+    if os.path.isdir(entry):
+        return
+
+    # write to a temporary directory first so that concurrent processes
+    # never see partial entries
+    tmp = tempfile.mkdtemp(dir=directory, prefix='.tmp_')
+    try:
+        for name, img in zip(names, imgs):
+            data = img.get_data()
+            cached = nb.Nifti1Image(data, img.get_affine(), img.get_header())
+            # store losslessly, whatever the header of the input said
+            cached.set_data_dtype(data.dtype)
+            cached.to_filename(os.path.join(tmp, name + '.nii'))
+        os.rename(tmp, entry)
+    except OSError:
+        # another process stored the same entry in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+    _evict()
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, f))
+               for f in os.listdir(entry))
+
+
+def _evict():
+    # removes least recently used entries until the cache fits max_size
+    directory = _config['directory']
+    entries = [os.path.join(directory, e) for e in os.listdir(directory)
+               if not e.startswith('.')]
+    entries = sorted((os.path.getmtime(e), _entry_size(e), e)
+                     for e in entries if os.path.isdir(e))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= _config['max_size']:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
@@ -0,0 +1,197 @@
+import functools
+import json
+import logging
+import threading
+import time
+
+
+# instrumentation is disabled until sinks are set with
+# "configure_instrumentation"
+_config = {'sinks': []}
+
+# spans that are open in each thread
+_local = threading.local()
+
+
+def configure_instrumentation(sinks=None):
+
+    '''
+    Enables the instrumentation of the pipeline. Every wrapper and I/O
+    function then records a span for each of its phases (e.g. loading,
+    passing arrays to the JVM, execute, reading the results back, saving)
+    with its wall-clock time, the bytes passed across the JNI boundary or
+    read and written, the resident memory of the process and the Java heap
+    usage. When disabled, a span costs a function call.
+
+        Parameters
+        -----------
+        sinks : List of functions that are called with the record of every
+            finished span, e.g. "log_sink", "json_sink" or records.append.
+            None or an empty list disables the instrumentation.
+
+        Records are dictionaries with the entries
+            'span' : name of the phase
+            'path' : names of the enclosing spans and this one joined by '/'
+            'start' : start time in seconds since the epoch
+            'seconds' : wall-clock time
+            'rss_mb', 'peak_rss_mb' : current and peak resident memory of
+                the process at the end of the span
+            'heap_used_mb', 'heap_peak_mb' : Java heap in use and largest use
+                seen (None if the JVM is not running)
+        any counters, e.g. 'jni_bytes_to_java', 'jni_bytes_from_java',
+        'bytes_read' and 'bytes_written', which include those of the spans
+        within, and further fields given by the function, e.g. 'file'.
+    '''
+
+    _config['sinks'] = list(sinks or [])
+
+
+def instrumentation_enabled():
+    return bool(_config['sinks'])
+
+
+def log_sink(logger='laminar_python', level=logging.INFO):
+
+    '''
+    Returns a sink that logs each record as a JSON string.
+
+        Parameters
+        -----------
+        logger : Name of the logger or logging.Logger object
+        level : Logging level of the messages
+    '''
+
+    if not isinstance(logger, logging.Logger):
+        logger = logging.getLogger(logger)
+
+    def sink(record):
+        logger.log(level, json.dumps(record, sort_keys=True))
+    return sink
+
+
+def json_sink(fname):
+
+    '''
+    Returns a sink that appends each record as one line of JSON to a file.
+    '''
+
+    lock = threading.Lock()
+
+    def sink(record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with lock:
+            with open(fname, 'a') as f:
+                f.write(line)
+    return sink
+
+
+class _NullSpan(object):
+    # returned while the instrumentation is disabled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.counters = {}
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        self.path = (self.parent.path + '/' if self.parent else '') + \
+            self.name
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.time() - self.start
+        _stack().pop()
+        if self.parent is not None:
+            for key, value in self.counters.items():
+                self.parent.counters[key] = \
+                    self.parent.counters.get(key, 0) + value
+
+        from jvm import memory_usage
+        report = memory_usage()
+        record = {'span': self.name, 'path': self.path, 'start': self.start,
+                  'seconds': seconds, 'rss_mb': report['rss_mb'],
+                  'peak_rss_mb': report['peak_rss_mb'],
+                  'heap_used_mb': report['heap_used_mb'],
+                  'heap_peak_mb': report['heap_peak_mb']}
+        if exc[0] is not None:
+            record['error'] = exc[0].__name__
+        record.update(self.counters)
+        record.update(self.fields)
+        for sink in _config['sinks']:
+            sink(record)
+        return False
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def span(name, **fields):
+
+    '''
+    Context manager recording a phase of the pipeline, e.g.
+
+        with span('execute', stage='layering') as s:
+            ...
+            s.add(bytes_written=n_bytes)
+
+    Counters added with s.add are summed into the enclosing spans. Spans
+    opened in other threads (e.g. background writes) are recorded on their
+    own.
+    '''
+
+    if not _config['sinks']:
+        return _NULL_SPAN
+    return _Span(name, fields)
+
+
+def count(**counters):
+
+    '''
+    Adds counters to the innermost open span of the calling thread.
+    '''
+
+    if _config['sinks']:
+        stack = _stack()
+        if stack:
+            stack[-1].add(**counters)
+
+
+def instrumented(func):
+
+    '''
+    Decorator recording every call of a function as a span named after it.
+    '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _config['sinks']:
+            return func(*args, **kwargs)
+        with _Span(func.__name__, {}):
+            return func(*args, **kwargs)
+    return wrapper
@@ -1,10 +1,17 @@
+import os
+import re
+import struct
+import zipfile
 import nibabel as nb
 import numpy as np
+from instrumentation import instrumented, count
 
 # function to load mesh geometry
+@instrumented
 def load_mesh_geometry(surf_mesh):
     # if input is a filename, try to load it with nibabel
     if isinstance(surf_mesh, basestring):
+        count(bytes_read=os.path.getsize(surf_mesh))
         if (surf_mesh.endswith('orig') or surf_mesh.endswith('pial') or
                 surf_mesh.endswith('white') or surf_mesh.endswith('sphere') or
                 surf_mesh.endswith('inflated')):
@@ -17,16 +24,18 @@ def load_mesh_geometry(surf_mesh):
         elif surf_mesh.endswith('ply'):
             coords, faces = read_ply(surf_mesh)
         elif surf_mesh.endswith('obj'):
-            coords, faces = read_obj(surf_mesh)
-        elif isinstance(surf_mesh, dict):
-            if ('faces' in surf_mesh and 'coords' in surf_mesh):
-                coords, faces = surf_mesh['coords'], surf_mesh['faces']
-            else:
-                raise ValueError('If surf_mesh is given as a dictionary it must '
-                                 'contain items with keys "coords" and "faces"')
+            coords, faces, normals, colours = read_obj(surf_mesh, True)
+            return {'coords':coords,'faces':faces,'normals':normals,
+                    'colours':colours}
+    elif isinstance(surf_mesh, dict):
+        if ('faces' in surf_mesh and 'coords' in surf_mesh):
+            coords, faces = surf_mesh['coords'], surf_mesh['faces']
         else:
-            raise ValueError('surf_mesh must be a either filename or a dictionary '
-                             'containing items with keys "coords" and "faces"')
+            raise ValueError('If surf_mesh is given as a dictionary it must '
+                             'contain items with keys "coords" and "faces"')
+    else:
+        raise ValueError('surf_mesh must be a either filename or a dictionary '
+                         'containing items with keys "coords" and "faces"')
     return {'coords':coords,'faces':faces}
 
 
@@ -91,125 +100,289 @@ def save_mesh_data(fname, surf_data):
 
 # function to read vtk files
 # ideally use pyvtk, but it didn't work for our data, look into why
+# data types of legacy vtk files, binary files are big-endian
+_VTK_TYPES = {'bit': 'u1', 'unsigned_char': 'u1', 'char': 'i1',
+              'unsigned_short': 'u2', 'short': 'i2', 'unsigned_int': 'u4',
+              'int': 'i4', 'unsigned_long': 'u8', 'long': 'i8',
+              'float': 'f4', 'double': 'f8', 'vtkidtype': 'i4'}
+# start of the next keyword line after an ASCII block of numbers
+_VTK_KEYWORD = re.compile(br'^[ \t]*(?!nan|inf)[A-Za-z_]', re.M | re.I)
+# lines starting the sections read or skipped by "read_vtk"
+_VTK_SECTION = re.compile(
+    br'^[ \t]*(POINTS|POLYGONS|VERTICES|LINES|TRIANGLE_STRIPS|METADATA|'
+    br'POINT_DATA|CELL_DATA|SCALARS|LOOKUP_TABLE|COLOR_SCALARS|VECTORS|'
+    br'NORMALS|TENSORS|TEXTURE_COORDINATES|FIELD)\b', re.M | re.I)
+
+
 def read_vtk(file):
     '''
-    Reads ASCII coded vtk files using pandas,
+    Reads ASCII or BINARY coded legacy vtk files in a single pass,
     returning vertices, faces and data as three numpy arrays.
+    Any number of values per line is accepted in ASCII files. Arrays have
+    the data types declared in the file in native byte order, for ASCII and
+    binary files alike. The data is the first SCALARS array of the points,
+    other attributes, fields and METADATA blocks are skipped.
     '''
-    import pandas as pd
-    import csv
-    # read full file while dropping empty lines
-    try:
-        vtk_df=pd.read_csv(file, header=None, engine='python')
-    except csv.Error:
-        raise ValueError('This vtk file appears to be binary coded currently only ASCII coded vtk files can be read')
-    vtk_df=vtk_df.dropna()
-    # extract number of vertices and faces
-    number_vertices=int(vtk_df[vtk_df[0].str.contains('POINTS')][0].iloc[0].split()[1])
-    number_faces=int(vtk_df[vtk_df[0].str.contains('POLYGONS')][0].iloc[0].split()[1])
-    # read vertices into df and array
-    start_vertices= (vtk_df[vtk_df[0].str.contains('POINTS')].index.tolist()[0])+1
-    vertex_df=pd.read_csv(file, skiprows=range(start_vertices), nrows=number_vertices, sep='\s*', header=None, engine='python')
-    if np.array(vertex_df).shape[1]==3:
-        vertex_array=np.array(vertex_df)
-    # sometimes the vtk format is weird with 9 indices per line, then it has to be reshaped
-    elif np.array(vertex_df).shape[1]==9:
-        vertex_df=pd.read_csv(file, skiprows=range(start_vertices), nrows=int(number_vertices/3)+1, sep='\s*', header=None, engine='python')
-        vertex_array=np.array(vertex_df.iloc[0:1,0:3])
-        vertex_array=np.append(vertex_array, vertex_df.iloc[0:1,3:6], axis=0)
-        vertex_array=np.append(vertex_array, vertex_df.iloc[0:1,6:9], axis=0)
-        for row in range(1,(int(number_vertices/3)+1)):
-            for col in [0,3,6]:
-                vertex_array=np.append(vertex_array, np.array(vertex_df.iloc[row:(row+1),col:(col+3)]),axis=0)
-        # strip rows containing nans
-        vertex_array=vertex_array[ ~np.isnan(vertex_array) ].reshape(number_vertices,3)
-    else:
-        print "vertex indices out of shape"
-    # read faces into df and array
-    start_faces= (vtk_df[vtk_df[0].str.contains('POLYGONS')].index.tolist()[0])+1
-    face_df=pd.read_csv(file, skiprows=range(start_faces), nrows=number_faces, sep='\s*', header=None, engine='python')
-    face_array=np.array(face_df.iloc[:,1:4])
-    # read data into df and array if exists
-    if vtk_df[vtk_df[0].str.contains('POINT_DATA')].index.tolist()!=[]:
-        start_data=(vtk_df[vtk_df[0].str.contains('POINT_DATA')].index.tolist()[0])+3
-        number_data = number_vertices
-        data_df=pd.read_csv(file, skiprows=range(start_data), nrows=number_data, sep='\s*', header=None, engine='python')
-        data_array=np.array(data_df)
-    else:
-        data_array = np.empty(0)
+    with open(file, 'rb') as f:
+        buf = bytearray(os.path.getsize(file))
+        f.readinto(buf)
+    pos = [0]
+
+    def next_line():
+        # returns the next non-empty line as a string
+        while pos[0] < len(buf):
+            end = buf.find(b'\n', pos[0])
+            if end < 0:
+                end = len(buf)
+            line = bytes(buf[pos[0]:end]).decode('ascii', 'replace').strip()
+            pos[0] = end + 1
+            if line:
+                return line
+        return None
+
+    def read_values(count, vtk_type, skip=False):
+        # reads a block of values, or moves past it if skip is set
+        if vtk_type.lower() not in _VTK_TYPES:
+            raise ValueError('%s contains values of unknown type %s' %
+                             (file, vtk_type))
+        dtype = np.dtype(_VTK_TYPES[vtk_type.lower()])
+        if binary:
+            if skip:
+                pos[0] += count * dtype.itemsize
+                return None
+            # converted to native byte order, as ASCII values are
+            values = np.frombuffer(buf, dtype=dtype.newbyteorder('>'),
+                                   count=count, offset=pos[0]).astype(
+                                       dtype, copy=False)
+            pos[0] += count * dtype.itemsize
+        else:
+            match = _VTK_KEYWORD.search(buf, pos[0])
+            end = match.start() if match else len(buf)
+            if skip:
+                pos[0] = end
+                return None
+            values = np.fromstring(bytes(buf[pos[0]:end]), dtype=dtype,
+                                   sep=' ')[:count]
+            pos[0] = end
+        if values.size != count:
+            raise ValueError('%s ends within a block of %i values' %
+                             (file, count))
+        return values
 
+    def skip_metadata():
+        # METADATA blocks of VTK 8 and later are text up to an empty line
+        while pos[0] < len(buf):
+            end = buf.find(b'\n', pos[0])
+            if end < 0:
+                end = len(buf)
+            line = bytes(buf[pos[0]:end]).strip()
+            pos[0] = end + 1
+            if not line:
+                return
+
+    def skip_metadata_if_present():
+        start = pos[0]
+        line = next_line()
+        if line is not None and line.upper() == 'METADATA':
+            skip_metadata()
+        else:
+            pos[0] = start
+
+    if not next_line().startswith('# vtk'):
+        raise ValueError('%s is not a legacy vtk file' % file)
+    next_line()
+    binary = next_line().upper() == 'BINARY'
+    if next_line().upper() != 'DATASET POLYDATA':
+        raise ValueError('%s does not contain POLYDATA' % file)
+
+    vertex_array = face_array = None
+    data_array = np.empty(0)
+    # number of tuples of the attributes that follow POINT_DATA or CELL_DATA
+    number_data = None
+    point_data = False
+    line = next_line()
+    while line is not None:
+        words = line.split()
+        keyword = words[0].upper()
+        if keyword == 'POINTS':
+            number_vertices = int(words[1])
+            vertex_array = read_values(3 * number_vertices,
+                                       words[2]).reshape(-1, 3)
+        elif keyword in ('POLYGONS', 'VERTICES', 'LINES',
+                         'TRIANGLE_STRIPS'):
+            cells = read_values(int(words[2]), 'int',
+                                skip=keyword != 'POLYGONS')
+            if keyword == 'POLYGONS':
+                number_faces = int(words[1])
+                if cells.size != 4 * number_faces or \
+                        np.any(cells[::4] != 3):
+                    raise ValueError('Only triangular meshes can be read')
+                face_array = cells.reshape(-1, 4)[:, 1:]
+        elif keyword == 'METADATA':
+            skip_metadata()
+        elif keyword in ('POINT_DATA', 'CELL_DATA'):
+            number_data = int(words[1])
+            point_data = keyword == 'POINT_DATA'
+        elif keyword == 'SCALARS' and number_data is not None:
+            n_components = int(words[3]) if len(words) > 3 else 1
+            start = pos[0]
+            if not next_line().upper().startswith('LOOKUP_TABLE'):
+                # the lookup table line is optional
+                pos[0] = start
+            # only the first scalars of the points are returned
+            skip = not point_data or data_array.size > 0
+            values = read_values(number_data * n_components, words[2], skip)
+            if not skip:
+                data_array = values.reshape(number_data, n_components)
+        elif keyword == 'LOOKUP_TABLE' and len(words) > 2:
+            # RGBA tables, bytes in binary files and floats in ASCII files
+            read_values(4 * int(words[2]),
+                        'unsigned_char' if binary else 'float', skip=True)
+        elif keyword == 'COLOR_SCALARS' and number_data is not None:
+            read_values(number_data * int(words[2]),
+                        'unsigned_char' if binary else 'float', skip=True)
+        elif keyword in ('VECTORS', 'NORMALS') and number_data is not None:
+            read_values(3 * number_data, words[2], skip=True)
+        elif keyword == 'TENSORS' and number_data is not None:
+            read_values(9 * number_data, words[2], skip=True)
+        elif keyword == 'TEXTURE_COORDINATES' and number_data is not None:
+            read_values(int(words[2]) * number_data, words[3], skip=True)
+        elif keyword == 'FIELD':
+            # arrays are sized by their own header lines
+            for _ in range(int(words[2])):
+                skip_metadata_if_present()
+                name, n_components, n_tuples, vtk_type = next_line().split()
+                read_values(int(n_components) * int(n_tuples), vtk_type,
+                            skip=True)
+            skip_metadata_if_present()
+        else:
+            # sections of unknown size, e.g. of newer versions of the format,
+            # are skipped up to the next line starting with a keyword
+            match = _VTK_SECTION.search(buf, pos[0])
+            pos[0] = match.start() if match else len(buf)
+        line = next_line()
+
+    if vertex_array is None or face_array is None:
+        raise ValueError('%s has no POINTS or POLYGONS' % file)
     return vertex_array, face_array, data_array
 
-# function to read ASCII coded ply file
+# function to read ASCII or binary coded ply file
+# data types of ply properties
+_PLY_TYPES = {'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2',
+              'int': 'i4', 'uint': 'u4', 'float': 'f4', 'double': 'f8',
+              'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+              'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8'}
+
+
 def read_ply(file):
-    import pandas as pd
-    import csv
-    # read full file and drop empty lines
-    try:
-        ply_df = pd.read_csv(file, header=None, engine='python')
-    except csv.Error:
-        raise ValueError('This ply file appears to be binary coded currently only ASCII coded ply files can be read')
-    ply_df = ply_df.dropna()
-    # extract number of vertices and faces, and row that marks the end of header
-    number_vertices = int(ply_df[ply_df[0].str.contains('element vertex')][0].iloc[0].split()[2])
-    number_faces = int(ply_df[ply_df[0].str.contains('element face')][0].iloc[0].split()[2])
-    end_header = ply_df[ply_df[0].str.contains('end_header')].index.tolist()[0]
-    # read vertex coordinates into dict
-    vertex_df = pd.read_csv(file, skiprows=range(end_header + 1),
-                            nrows=number_vertices, sep='\s*', header=None,
-                            engine='python')
-    vertex_array = np.array(vertex_df)
-    # read face indices into dict
-    face_df = pd.read_csv(file, skiprows=range(end_header + number_vertices + 1),
-                          nrows=number_faces, sep='\s*', header=None,
-                          engine='python')
-    face_array = np.array(face_df.iloc[:, 1:4])
+    '''
+    Reads triangle meshes from ASCII or binary coded ply files in a single
+    pass, returning vertices and faces as two numpy arrays. Vertex
+    properties other than x, y and z are ignored.
+    '''
+    with open(file, 'rb') as f:
+        buf = bytearray(os.path.getsize(file))
+        f.readinto(buf)
+    end_header = buf.find(b'end_header')
+    if not buf.startswith(b'ply') or end_header < 0:
+        raise ValueError('%s is not a ply file' % file)
+    start = buf.find(b'\n', end_header) + 1
+
+    # parse the header into the elements and their properties
+    fmt = None
+    elements = []
+    for line in bytes(buf[:end_header]).decode('ascii').splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            elements[-1][2].append(words[1:])
+    if [e[0] for e in elements[:2]] != ['vertex', 'face']:
+        raise ValueError('%s must contain vertex and face elements' % file)
+    (_, number_vertices, vertex_props), (_, number_faces, face_props) = \
+        elements[:2]
+    names = [prop[-1] for prop in vertex_props]
+    if len(face_props) != 1 or face_props[0][0] != 'list':
+        raise ValueError('Faces must have a single list of vertex indices')
+
+    if fmt == 'ascii':
+        values = np.fromstring(bytes(buf[start:]), sep=' ')
+        n_vertex_values = number_vertices * len(names)
+        vertex_array = values[:n_vertex_values].reshape(number_vertices, -1)
+        face_array = values[n_vertex_values:n_vertex_values +
+                            4 * number_faces].reshape(-1, 4)
+        counts = face_array[:, 0]
+        face_array = face_array[:, 1:].astype(int)
+    elif fmt in ('binary_little_endian', 'binary_big_endian'):
+        order = '<' if fmt == 'binary_little_endian' else '>'
+        vertex_dtype = np.dtype([(prop[-1], order + _PLY_TYPES[prop[0]])
+                                 for prop in vertex_props])
+        vertices = np.frombuffer(buf, dtype=vertex_dtype,
+                                 count=number_vertices, offset=start)
+        vertex_array = np.column_stack([vertices[name]
+                                        for name in names])
+        _, count_type, index_type, _ = face_props[0]
+        face_dtype = np.dtype([('n', order + _PLY_TYPES[count_type]),
+                               ('v', order + _PLY_TYPES[index_type], 3)])
+        faces = np.frombuffer(buf, dtype=face_dtype, count=number_faces,
+                              offset=start + vertices.nbytes)
+        counts = faces['n']
+        face_array = faces['v']
+    else:
+        raise ValueError('Unknown ply format %s' % fmt)
+    if np.any(counts != 3):
+        raise ValueError('Only triangular meshes can be read')
+    vertex_array = vertex_array[:, [names.index(n) for n in 'xyz']]
 
     return vertex_array, face_array
 
 #function to read MNI obj mesh format
-def read_obj(file):
-    def chunks(l,n):
-      """Yield n-sized chunks from l"""
-      for i in xrange(0, len(l), n):
-          yield l[i:i+n]
-    def indices(lst,element):
-        result=[]
-        offset = -1
-        while True:
-            try:
-                offset=lst.index(element,offset+1)
-            except ValueError:
-                return result
-            result.append(offset)
-    fp=open(file,'r')
-    n_vert=[]
-    n_poly=[]
-    k=0
-    Polys=[]
-	# Find number of vertices and number of polygons, stored in .obj file.
-	#Then extract list of all vertices in polygons
-    for i, line in enumerate(fp):
-         if i==0:
-    	#Number of vertices
-             n_vert=int(line.split()[6])
-             XYZ=np.zeros([n_vert,3])
-         elif i<=n_vert:
-             XYZ[i-1]=map(float,line.split())
-         elif i>2*n_vert+5:
-             if not line.strip():
-                 k=1
-             elif k==1:
-                 Polys.extend(line.split())
-    Polys=map(int,Polys)
-    npPolys=np.array(Polys)
-    triangles=np.array(list(chunks(Polys,3)))
+def read_obj(file, attributes=False):
+    '''
+    Reads triangle meshes from MNI obj files, returning vertices and faces
+    as two numpy arrays, and if attributes is True also the vertex normals
+    and the colours (one RGBA row, or one per vertex or face).
+    '''
+    with open(file, 'rb') as f:
+        content = f.read()
+    # after the leading 'P' the file consists only of numbers, which are
+    # parsed at once and split into the sections by their lengths
+    if not content.lstrip().startswith(b'P'):
+        raise ValueError('%s is not an MNI obj polygon file' % file)
+    values = np.fromstring(content.lstrip()[1:], sep=' ')
+    n_vert = int(values[5])
+    pos = 6
+    XYZ = values[pos:pos + 3 * n_vert].reshape(n_vert, 3)
+    pos += 3 * n_vert
+    normals = values[pos:pos + 3 * n_vert].reshape(n_vert, 3)
+    pos += 3 * n_vert
+    n_poly = int(values[pos])
+    colour_flag = int(values[pos + 1])
+    pos += 2
+    n_colours = {0: 1, 1: n_poly, 2: n_vert}[colour_flag]
+    colours = values[pos:pos + 4 * n_colours].reshape(n_colours, 4)
+    pos += 4 * n_colours
+    end_indices = values[pos:pos + n_poly].astype(int)
+    pos += n_poly
+    Polys = values[pos:].astype(int)
+    if len(Polys) != 3 * n_poly or np.any(end_indices !=
+                                         np.arange(3, 3 * n_poly + 1, 3)):
+        raise ValueError('Only triangular meshes can be read')
+    triangles = Polys.reshape(n_poly, 3)
+    if attributes:
+        return XYZ, triangles, normals, colours
     return XYZ, triangles;
 
 
 
 # function to save mesh geometry
-def save_mesh_geometry(fname,surf_dict):
+@instrumented
+def save_mesh_geometry(fname,surf_dict,binary=False):
+    # binary selects binary coding for vtk and ply files
     # if input is a filename, try to load it with nibabel
     if isinstance(fname, basestring) and isinstance(surf_dict,dict):
         if (fname.endswith('orig') or fname.endswith('pial') or
@@ -220,16 +393,18 @@ def save_mesh_geometry(fname,surf_dict):
         elif fname.endswith('gii'):
             write_gifti(fname,surf_dict['coords'],surf_dict['faces'])
         elif fname.endswith('vtk'):
-            if 'data' in surf_dict.keys():
-                write_vtk(fname,surf_dict['coords'],surf_dict['faces'],surf_dict['data'])
-            else:
-                write_vtk(fname,surf_dict['coords'],surf_dict['faces'])
+            write_vtk(fname,surf_dict['coords'],surf_dict['faces'],
+                      surf_dict.get('data'),binary=binary)
         elif fname.endswith('ply'):
-            write_ply(fname,surf_dict['coords'],surf_dict['faces'])
+            write_ply(fname,surf_dict['coords'],surf_dict['faces'],
+                      binary=binary)
         elif fname.endswith('obj'):
-            save_obj(fname,surf_dict['coords'],surf_dict['faces'])
+            save_obj(fname,surf_dict['coords'],surf_dict['faces'],
+                     surf_dict.get('normals'),surf_dict.get('colours'))
             print('to view mesh in brainview, run the command:\n')
             print('average_objects ' + fname + ' ' + fname)
+        if os.path.isfile(fname):
+            count(bytes_written=os.path.getsize(fname))
     else:
         raise ValueError('fname must be a filename and surf_dict must be a dictionary')
 
@@ -244,64 +419,174 @@ def write_gifti(surf_mesh, coords, faces):
     nb.gifti.write(gii, surf_mesh)
 
 
-def save_obj(surf_mesh,coords,faces):
-#write out MNI - obj format
+def _obj_rows(values, n_columns):
+    # formats values as rows of n_columns numbers, each number preceded by a
+    # space and converted with str(), and a last row with the remainder, even
+    # if it is empty
+    values = list(values)
+    n_full = len(values) // n_columns * n_columns
+    row = ' %s' * n_columns + '\n'
+    return ((row * (n_full // n_columns)) % tuple(values[:n_full]) + ' ' +
+            ' '.join(map(str, values[n_full:])) + '\n')
+
+
+def save_obj(surf_mesh,coords,faces,normals=None,colours=None):
+    '''
+    Writes a triangle mesh in MNI obj format. normals (n_vertices, 3) and
+    colours (RGBA, one row for the whole mesh or one per vertex) are
+    optional, by default normals are zero and the mesh is white.
+    Vertices and faces are written exactly as by previous versions.
+    '''
     n_vert=len(coords)
-    XYZ=coords.tolist()
-    Tri=faces.tolist()
+    n_tri=len(faces)
     with open(surf_mesh,'w') as s:
-        line1="P 0.3 0.3 0.4 10 1 " + str(n_vert) + "\n"
-        s.write(line1)
-        k=-1
-        for a in XYZ:
-            k+=1
-            cor=' ' + ' '.join(map(str, XYZ[k]))
-            s.write('%s\n' % cor)
+        s.write("P 0.3 0.3 0.4 10 1 " + str(n_vert) + "\n")
+        s.write((' %s %s %s\n' * n_vert) % tuple(np.ravel(coords).tolist()))
         s.write('\n')
-        for a in XYZ:
-            s.write(' 0 0 0\n')
+        if normals is None:
+            s.write(' 0 0 0\n' * n_vert)
+        else:
+            s.write((' %s %s %s\n' * n_vert) %
+                    tuple(np.ravel(normals).tolist()))
         s.write('\n')
-        l=' ' + str(len(Tri))+'\n'
-        s.write(l)
-        s.write(' 0 1 1 1 1\n')
+        s.write(' ' + str(n_tri) + '\n')
+        if colours is None:
+            s.write(' 0 1 1 1 1\n')
+        elif len(colours) == 1 or np.ndim(colours) == 1:
+            s.write(' 0' + (' %s' * 4) % tuple(np.ravel(colours).tolist()) +
+                    '\n')
+        else:
+            # colours per vertex (flag 2) or per face (flag 1)
+            flag = 2 if len(colours) == n_vert else 1
+            s.write(' %i\n' % flag + (' %s %s %s %s\n' * len(colours)) %
+                    tuple(np.ravel(colours).tolist()))
         s.write('\n')
-        nt=len(Tri)*3
-        Triangles=np.arange(3,nt+1,3)
-        Rounded8=np.shape(Triangles)[0]/8
-        N8=8*Rounded8
-        Triangles8=Triangles[0:N8]
-        RowsOf8=np.split(Triangles8,N8/8)
-        for r in RowsOf8:
-            L=r.tolist()
-            Lint=map(int,L)
-            Line=' ' + ' '.join(map(str, Lint))
-            s.write('%s\n' % Line)
-        L=Triangles[N8:].tolist()
-        Lint=map(int,L)
-        Line=' ' + ' '.join(map(str, Lint))
-        s.write('%s\n' % Line)
+        s.write(_obj_rows(range(3, 3 * n_tri + 1, 3), 8))
         s.write('\n')
-        ListOfTriangles=np.array(Tri).flatten()
-        Rounded8=np.shape(ListOfTriangles)[0]/8
-        N8=8*Rounded8
-        Triangles8=ListOfTriangles[0:N8]
-        ListTri8=ListOfTriangles[0:N8]
-        RowsOf8=np.split(Triangles8,N8/8)
-        for r in RowsOf8:
-            L=r.tolist()
-            Lint=map(int,L)
-            Line=' ' + ' '.join(map(str, Lint))
-            s.write('%s\n' % Line)
-        L=ListOfTriangles[N8:].tolist()
-        Lint=map(int,L)
-        Line=' ' + ' '.join(map(str, Lint))
-        s.write('%s\n' % Line)
-
-
-def write_vtk(filename, vertices, faces, data=None, comment=None):
+        s.write(_obj_rows(np.ravel(faces).astype(int).tolist(), 8))
+
+
+def _npz_member(fname, name):
+    # memory-maps an array stored uncompressed in an npz file, so that parts
+    # of it can be read without loading the whole array
+    with zipfile.ZipFile(fname) as archive:
+        info = archive.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.load(fname)[name]
+    with open(fname, 'rb') as f:
+        # the data follows the local file header and the npy header
+        f.seek(info.header_offset + 26)
+        name_len, extra_len = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order='F' if fortran else 'C')
+
+
+@instrumented
+def save_layered_mesh(fname, layered_mesh):
+    '''
+    Saves a stack of surfaces that share one triangulation, e.g. the
+    intracortical surfaces of "profile_meshing".
+
+    Parameters
+    ----------
+    fname : filename ending in 'npz' or 'gii'. npz files are written
+        uncompressed, so that single layers can be read without loading the
+        others (see "load_layered_mesh"). gii files have one pointset per
+        layer, the triangles once and then one data array per layer.
+    layered_mesh : dictionary with 'coords' (n_layers, n_vertices, 3), 'faces'
+        (n_faces, 3) and optionally 'data' (n_layers, n_vertices[, n]).
+        Coordinates and data are stored as float32, faces as int32.
+    '''
+    coords = np.asarray(layered_mesh['coords'], dtype=np.float32)
+    faces = np.asarray(layered_mesh['faces'], dtype=np.int32)
+    data = layered_mesh.get('data')
+    if data is not None:
+        data = np.asarray(data, dtype=np.float32)
+    if fname.endswith('npz'):
+        arrays = {'coords': coords, 'faces': faces}
+        if data is not None:
+            arrays['data'] = data
+        np.savez(fname, **arrays)
+    elif fname.endswith('gii'):
+        darrays = [nb.gifti.GiftiDataArray(
+                       data=layer, intent=nb.nifti1.intent_codes[
+                           'NIFTI_INTENT_POINTSET']) for layer in coords]
+        darrays.append(nb.gifti.GiftiDataArray(
+            data=faces, intent=nb.nifti1.intent_codes['NIFTI_INTENT_TRIANGLE']))
+        if data is not None:
+            darrays.extend(nb.gifti.GiftiDataArray(
+                data=layer, intent=nb.nifti1.intent_codes['NIFTI_INTENT_NONE'])
+                for layer in data)
+        nb.gifti.write(nb.gifti.GiftiImage(darrays=darrays), fname)
+    else:
+        raise ValueError('Layered meshes can be saved as npz or gii')
+    count(bytes_written=os.path.getsize(fname))
+
+
+@instrumented
+def load_layered_mesh(fname, layer=None):
+    '''
+    Loads a stack of surfaces saved with "save_layered_mesh".
+
+    Parameters
+    ----------
+    fname : npz or gii file
+    layer : index or slice of the layers to return. Default is all layers.
+        From npz files only the selected layers are read.
+
+    Returns
+    -------
+    dictionary with 'coords', 'faces' and, if saved, 'data'. For a single
+    layer index 'coords' has shape (n_vertices, 3), otherwise
+    (n_layers, n_vertices, 3). Arrays from npz files are read-only.
+    '''
+    select = slice(None) if layer is None else layer
+    if fname.endswith('npz'):
+        with zipfile.ZipFile(fname) as archive:
+            names = archive.namelist()
+        mesh = {'coords': _npz_member(fname, 'coords')[select],
+                'faces': _npz_member(fname, 'faces')}
+        if 'data.npy' in names:
+            mesh['data'] = _npz_member(fname, 'data')[select]
+    elif fname.endswith('gii'):
+        gii = nb.load(fname)
+        intents = nb.nifti1.intent_codes
+        coords = [d.data for d in gii.darrays
+                  if d.intent == intents['NIFTI_INTENT_POINTSET']]
+        mesh = {'coords': np.array(coords)[select],
+                'faces': gii.getArraysFromIntent(
+                    intents['NIFTI_INTENT_TRIANGLE'])[0].data}
+        data = [d.data for d in gii.darrays
+                if d.intent == intents['NIFTI_INTENT_NONE']]
+        if data:
+            mesh['data'] = np.array(data)[select]
+    else:
+        raise ValueError('Layered meshes can be loaded from npz or gii')
+    return mesh
+
+
+def _write_rows(f, fmt, array, chunk_size=100000):
+    # writes the rows of a 2D array with a printf format per row, formatting
+    # chunk_size rows at once
+    for start in range(0, len(array), chunk_size):
+        chunk = array[start:start + chunk_size]
+        f.write((((fmt + '\n') * len(chunk)) %
+                 tuple(chunk.ravel().tolist())).encode('ascii'))
+
+
+def write_vtk(filename, vertices, faces, data=None, comment=None,
+              binary=False):
 
     '''
-    Creates ASCII coded vtk file from numpy arrays using pandas.
+    Creates ASCII or BINARY coded legacy vtk file from numpy arrays.
+    Each section is written in turn to a single open file.
     Inputs:
     -------
     (mandatory)
@@ -310,89 +595,81 @@ def write_vtk(filename, vertices, faces, data=None, comment=None):
     * faces: numpy array with face specifications, shape (n_faces, 3)
     (optional)
     * data: numpy array with data points, shape (n_vertices, n_datapoints)
-        NOTE: n_datapoints can be =1 but cannot be skipped (n_vertices,)
+        or (n_vertices,)
     * comment: str, is written into the comment section of the vtk file
+    * binary: bool, whether arrays should be written in binary (big-endian)
+        instead of ASCII, default is False
     Usage:
     ---------------------
     write_vtk('/path/to/vtk/file.vtk', v_array, f_array)
     '''
 
-    import pandas as pd
-    # infer number of vertices and faces
-    number_vertices=vertices.shape[0]
-    number_faces=faces.shape[0]
-    if data is not None:
-        number_data=data.shape[0]
-    # make header and subheader dataframe
-    header=['# vtk DataFile Version 3.0',
-            '%s'%comment,
-            'ASCII',
-            'DATASET POLYDATA',
-            'POINTS %i float'%number_vertices
-             ]
-    header_df=pd.DataFrame(header)
-    sub_header=['POLYGONS %i %i'%(number_faces, 4*number_faces)]
-    sub_header_df=pd.DataFrame(sub_header)
-    # make dataframe from vertices
-    vertex_df=pd.DataFrame(vertices)
-    # make dataframe from faces, appending first row of 3's (indicating the polygons are triangles)
-    triangles=np.reshape(3*(np.ones(number_faces)), (number_faces,1))
-    triangles=triangles.astype(int)
-    faces=faces.astype(int)
-    faces_df=pd.DataFrame(np.concatenate((triangles,faces),axis=1))
-    # write dfs to csv
-    header_df.to_csv(filename, header=None, index=False)
-    with open(filename, 'a') as f:
-        vertex_df.to_csv(f, header=False, index=False, float_format='%.3f', sep=' ')
-    with open(filename, 'a') as f:
-        sub_header_df.to_csv(f, header=False, index=False)
-    with open(filename, 'a') as f:
-        faces_df.to_csv(f, header=False, index=False, float_format='%.0f', sep=' ')
-    # if there is data append second subheader and data
-    if data != None:
-        datapoints=data.shape[1]
-        sub_header2=['POINT_DATA %i'%(number_data),
-                     'SCALARS EmbedVertex float %i'%(datapoints),
-                     'LOOKUP_TABLE default']
-        sub_header_df2=pd.DataFrame(sub_header2)
-        data_df=pd.DataFrame(data)
-        with open(filename, 'a') as f:
-            sub_header_df2.to_csv(f, header=False, index=False)
-        with open(filename, 'a') as f:
-            data_df.to_csv(f, header=False, index=False, float_format='%.16f', sep=' ')
-
-
-def write_ply(filename, vertices, faces, comment=None):
-    import pandas as pd
+    vertices = np.asarray(vertices)
+    faces = np.asarray(faces)
+    number_vertices = vertices.shape[0]
+    number_faces = faces.shape[0]
+    cells = np.column_stack((np.full(number_faces, 3, dtype=int), faces))
+    with open(filename, 'wb') as f:
+        f.write(('# vtk DataFile Version 3.0\n%s\n%s\nDATASET POLYDATA\n'
+                 'POINTS %i float\n' % (comment, 'BINARY' if binary
+                                          else 'ASCII', number_vertices))
+                .encode('ascii'))
+        if binary:
+            vertices.astype('>f4').tofile(f)
+            f.write(b'\n')
+        else:
+            _write_rows(f, '%.3f %.3f %.3f', vertices)
+        f.write(('POLYGONS %i %i\n' % (number_faces, 4 * number_faces))
+                .encode('ascii'))
+        if binary:
+            cells.astype('>i4').tofile(f)
+            f.write(b'\n')
+        else:
+            _write_rows(f, '%i %i %i %i', cells)
+        # if there is data append second subheader and data
+        if data is not None:
+            data = np.asarray(data).reshape(number_vertices, -1)
+            f.write(('POINT_DATA %i\nSCALARS EmbedVertex float %i\n'
+                     'LOOKUP_TABLE default\n' % data.shape).encode('ascii'))
+            if binary:
+                data.astype('>f4').tofile(f)
+                f.write(b'\n')
+            else:
+                _write_rows(f, ' '.join(['%.9g'] * data.shape[1]), data)
+
+
+def write_ply(filename, vertices, faces, comment=None, binary=False):
+
+    '''
+    Creates ASCII or binary_little_endian coded ply file from numpy arrays,
+    written to a single open file. The parameters are as for "write_vtk".
+    '''
+
     print "writing ply format"
-    # infer number of vertices and faces
+    vertices = np.asarray(vertices)
+    faces = np.asarray(faces)
     number_vertices = vertices.shape[0]
     number_faces = faces.shape[0]
-    # make header dataframe
     header = ['ply',
-            'format ascii 1.0',
-            'comment %s' % comment,
-            'element vertex %i' % number_vertices,
-            'property float x',
-            'property float y',
-            'property float z',
-            'element face %i' % number_faces,
-            'property list uchar int vertex_indices',
-            'end_header'
-             ]
-    header_df = pd.DataFrame(header)
-    # make dataframe from vertices
-    vertex_df = pd.DataFrame(vertices)
-    # make dataframe from faces, adding first row of 3s (indicating triangles)
-    triangles = np.reshape(3 * (np.ones(number_faces)), (number_faces, 1))
-    triangles = triangles.astype(int)
-    faces = faces.astype(int)
-    faces_df = pd.DataFrame(np.concatenate((triangles, faces), axis=1))
-    # write dfs to csv
-    header_df.to_csv(filename, header=None, index=False)
-    with open(filename, 'a') as f:
-        vertex_df.to_csv(f, header=False, index=False,
-                         float_format='%.3f', sep=' ')
-    with open(filename, 'a') as f:
-        faces_df.to_csv(f, header=False, index=False,
-                        float_format='%.0f', sep=' ')
+              'format %s 1.0' % ('binary_little_endian' if binary
+                                 else 'ascii'),
+              'comment %s' % comment,
+              'element vertex %i' % number_vertices,
+              'property float x',
+              'property float y',
+              'property float z',
+              'element face %i' % number_faces,
+              'property list uchar int vertex_indices',
+              'end_header']
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        if binary:
+            vertices.astype('<f4').tofile(f)
+            face_records = np.empty(number_faces,
+                                    dtype=[('n', 'u1'), ('v', '<i4', 3)])
+            face_records['n'] = 3
+            face_records['v'] = faces
+            face_records.tofile(f)
+        else:
+            _write_rows(f, '%.3f %.3f %.3f', vertices)
+            _write_rows(f, '3 %i %i %i', faces)
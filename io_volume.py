@@ -1,70 +1,319 @@
+import os
+import atexit
+import itertools
 import nibabel as nb
 import numpy as np
+from instrumentation import instrumented, span, count
 
 # function to read volumetric tissue classification and turn into 3D array
-def load_volume(mri_vol):
+def load_volume(mri_vol, mmap=True):
+    """
+    Function to load a volume lazily. The data is only read when it is
+    accessed, uncompressed Nifti files are memory-mapped (see "load_data").
+    Input:
+        - mri_vol:  filename of a Nifti ('nii', 'nii.gz') or MINC ('mnc')
+                    file, or a nibabel image which is returned as it is
+        - mmap:     whether uncompressed files are memory-mapped
+    Output:
+        - nibabel image, MINC files are converted to Nifti images
+    """
     # if input is a filename, try to load it
     if isinstance(mri_vol, basestring):
     # importing nifti files
         if (mri_vol.endswith('nii') or mri_vol.endswith('nii.gz')):
-            img=nb.load(mri_vol)
-            # importing mnc files using pyminc, suggest to download if missing
+            img=nb.load(mri_vol, mmap=mmap)
         elif mri_vol.endswith('mnc'):
-            try:
-                import minc as pyezminc
-                img=pyezminc.mnc2nii(mri_vol)
-            except ValueError:
-                print "failed import pyezminc. try installing"
+            img=mnc2nii(mri_vol)
+        else:
+            raise ValueError('volume must be a Nifti or MINC file')
 # option to add in more file types here, eg analyze
-# if volume is already an np array
     elif isinstance(mri_vol, nb.spatialimages.SpatialImage):
         img=mri_vol
-# img_data=np.array(mri_vol)
     else:
                 raise ValueError('volume must be a either filename or a nibabel image')
     return img;
 
 
+@instrumented
+def load_data(mri_vol, dtype=None, volumes=None):
+    """
+    Function to read the data of a volume without caching it in the image,
+    reading only the requested volumes of 4D images.
+    Input:
+        - mri_vol:  filename or nibabel image
+        - dtype:    numpy data type of the array. Scaled integer data is
+                    scaled in this type instead of float64. None returns the
+                    data as nibabel does
+        - volumes:  index, slice or list of indices along the fourth axis,
+                    None to read all of the data
+    Output:
+        - numpy array in Fortran order. Unscaled data of uncompressed files
+          read as a whole in their stored data type is a copy-on-write
+          memmap of the file.
+    """
+    img = load_volume(mri_vol)
+    proxy = img.dataobj
+    slope, inter = 1., 0.
+    if dtype is not None and isinstance(proxy, nb.arrayproxy.ArrayProxy):
+        slope, inter = proxy.slope, proxy.inter
+        if (slope, inter) != (1., 0.):
+            # read the stored values, scaled below without a float64 copy
+            proxy = nb.arrayproxy.ArrayProxy(
+                proxy.file_like,
+                (proxy.shape, proxy.dtype, proxy.offset, 1., 0.))
+
+    if volumes is None:
+        data = np.asanyarray(proxy)
+    elif isinstance(volumes, (int, np.integer, slice)):
+        data = np.asanyarray(proxy[:, :, :, volumes])
+    else:
+        data = None
+        for i, volume in enumerate(volumes):
+            block = np.asanyarray(proxy[:, :, :, volume])
+            if data is None:
+                data = np.empty(block.shape[:3] + (len(volumes),) +
+                                block.shape[3:], dtype=dtype or block.dtype,
+                                order='F')
+            data[:, :, :, i] = block
+
+    if dtype is not None:
+        if (slope, inter) != (1., 0.):
+            data = data.astype(dtype)
+            data *= slope
+            data += inter
+        else:
+            data = data.astype(dtype, copy=False)
+    count(bytes_read=data.nbytes)
+    return data
+
+
+# settings of the background writer, see "configure_writer"
+_config = {'background': False, 'n_threads': 2, 'compresslevel': None}
+
+# thread pool of the background writer and the writes not yet waited for
+_writer = {'pool': None, 'pending': [], 'exit_handler': False}
+
+# numbers the temporary files that volumes are written to
+_tmp_count = itertools.count()
+
+
+def configure_writer(background=False, n_threads=2, compresslevel=None):
+    """
+    Function to set how "save_volume" writes files. In the background,
+    volumes are written by a pool of threads while the pipeline continues,
+    compression releases the GIL so the writes overlap with the computation.
+    Input:
+        - background:       write all volumes in the background by default
+        - n_threads:        number of files written at the same time
+        - compresslevel:    default gzip level (0-9) for 'nii.gz' files, None
+                            for the nibabel default. 0 stores the data without
+                            compression, e.g. for scratch outputs; files
+                            ending in 'nii' are never compressed
+    """
+    if _writer['pool'] is not None and n_threads != _config['n_threads']:
+        # let pending writes finish in the old pool
+        _writer['pool'].close()
+        _writer['pool'] = None
+    _config['background'] = background
+    _config['n_threads'] = n_threads
+    _config['compresslevel'] = compresslevel
+
+
+def _write_volume(fname, img, dtype, CLOBBER, compresslevel):
+    if os.path.isfile(fname) and not CLOBBER:
+        print("This file exists and CLOBBER was set to false, file not saved.")
+        return None
+    # write a copy so that setting the data type does not change the header
+    # of the caller's image, the data itself is not copied
+    out = img.__class__(img.dataobj, img.affine, img.header)
+    if dtype is not None:  # if there is a particular data_type chosen, set it
+        out.set_data_dtype(dtype)
+    # write to a hidden file with the same suffix in the same directory and
+    # rename it when complete, so a partial file never has the final name
+    dir_name, base_name = os.path.split(fname)
+    tmp_name = os.path.join(dir_name, '.%d_%d_%s' % (
+        os.getpid(), next(_tmp_count), base_name))
+    with span('save_volume', file=fname) as s:
+        try:
+            if fname.endswith('gz') and compresslevel is not None:
+                import gzip
+                with gzip.GzipFile(tmp_name, 'wb', compresslevel) as fileobj:
+                    out.to_file_map({'image': nb.FileHolder(fileobj=fileobj)})
+            else:
+                out.to_filename(tmp_name)
+            os.rename(tmp_name, fname)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        s.add(bytes_written=os.path.getsize(fname))
+    return fname
+
+
 # function to save volume data
-def save_volume(fname, img, dtype='float32', CLOBBER=True):
+def save_volume(fname, img, dtype='float32', CLOBBER=True, compresslevel=None,
+                background=None):
     """
     Function to write volume data to file. Filetype is based on filename suffix
     Input:
         - fname:    you can figure that out
-        - data:             numpy array
-        - affine:              affine matrix
-        - header:        header data to write to file (use img.header to get the header of root file)
-        - data_type:        numpy data type ('uint32', 'float32' etc)
+        - img:              nibabel image, its header is not modified
+        - dtype:            numpy data type ('uint32', 'float32' etc), None
+                            to keep the data type of the image header
         - CLOBBER:          overwrite existing file
+        - compresslevel:    gzip level for 'nii.gz' files, default is set by
+                            "configure_writer"
+        - background:       return immediately and write the file in a
+                            thread, default is set by "configure_writer". The
+                            data must not be changed until the write finished.
+                            Writes still pending are finished when the
+                            interpreter exits.
+    Output:
+        - the filename (None if it was not saved), or in the background a
+          result whose get() waits for the write and returns the filename
+          (see also "wait_for_writes")
+    Files are written under a temporary name in the same directory and
+    renamed when complete, so an interrupted write leaves no partial file.
     """
-    import os
     if (fname.endswith('nii') or fname.endswith('nii.gz')):
-        if dtype is not None:  # if there is a particular data_type chosen, set it
-        # data=data.astype(data_type)
-            img.set_data_dtype(dtype)
-        if not (os.path.isfile(fname)) or CLOBBER:
-            img.to_filename(fname)
-        else:
-            print("This file exists and CLOBBER was set to false, file not saved.")
+        if compresslevel is None:
+            compresslevel = _config['compresslevel']
+        if background is None:
+            background = _config['background']
+        args = (fname, img, dtype, CLOBBER, compresslevel)
+        if not background:
+            return _write_volume(*args)
+        if _writer['pool'] is None:
+            from multiprocessing.pool import ThreadPool
+            _writer['pool'] = ThreadPool(_config['n_threads'])
+            if not _writer['exit_handler']:
+                atexit.register(_shutdown_writer)
+                _writer['exit_handler'] = True
+        result = _writer['pool'].apply_async(_write_volume, args)
+        _writer['pending'].append(result)
+        return result
  #    elif full_fileName.endswith('mnc')
 #               save minc using Thomas code
 
 
+def wait_for_writes():
+    """
+    Function to wait until all volumes saved in the background are written,
+    e.g. at the end of a pipeline.
+    Output:
+        - list of the filenames written
+    Errors of the writes are raised after all of them finished.
+    """
+    pending, _writer['pending'] = _writer['pending'], []
+    fnames, error = [], None
+    for result in pending:
+        try:
+            fnames.append(result.get())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    return [f for f in fnames if f is not None]
+
+
+def _shutdown_writer():
+    # finish the background writes of scripts that end without calling
+    # "wait_for_writes", whose daemon threads would otherwise be killed.
+    # Registered after multiprocessing's own exit handler, which terminates
+    # the pools, so that it runs before it
+    try:
+        wait_for_writes()
+    finally:
+        if _writer['pool'] is not None:
+            _writer['pool'].close()
+            _writer['pool'].join()
+            _writer['pool'] = None
+
+
 #loading in minc and converting to nii
 def mnc2nii(input_fn):
-	'''For a MINC input file, returns a nibabel nifti image.
-		This image can then be saved as a nifti file.'''
-	img_mnc=pyezminc.Image(fname=input_fn)
+    '''For a MINC input file, returns a nibabel nifti image.
+    This image can then be saved as a nifti file. The data is read lazily
+    by the MINC reader of nibabel (MINC2 files need h5py).'''
+    img_mnc = nb.load(input_fn)
+    return nb.Nifti1Image.from_image(img_mnc)
 
-	#Create empty instance of a Nibabel image
-	img_nii = nib.Nifti1Image(img_mnc.data, np.eye(4))
 
-	for space, row in zip(['xspace', 'yspace', 'zspace'],['srow_x', 'srow_y', 'srow_z'] ):
-		img_nii.header[row]=img_mnc.header[space]['direction_cosines'] + img_mnc.header[space]['start']
-	affine= [img_nii.header['srow_x'], img_nii.header['srow_y'], img_nii.header['srow_z'], [0,0,0,1]]
+def _nifti_header(shape, affine, header=None, dtype='float32'):
+    # single file Nifti header in native byte order for data written
+    # directly after it, with voxel sizes and units taken from header
+    hdr = nb.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+    if header is not None:
+        zooms = tuple(header.get_zooms()[:len(shape)])
+        hdr.set_zooms(zooms + (1.,) * (len(shape) - len(zooms)))
+        hdr.set_xyzt_units(*header.get_xyzt_units())
+    hdr.set_slope_inter(None, None)
+    hdr.set_qform(affine)
+    hdr.set_sform(affine)
+    hdr.set_data_offset(352)
+    return hdr
 
 
-	#Return data structure, data, header, affine
-	return(img_nii) #, img_mnc.data, img_nii.header, affine )
+def volume_memmap(fname, shape, affine, header=None, dtype='float32'):
+    """
+    Function to create an uncompressed Nifti file and map its data into
+    memory, so that it can be filled piece by piece without holding the full
+    volume in memory.
+    Input:
+        - fname:    filename ending in 'nii'
+        - shape:    shape of the volume
+        - affine:   affine matrix
+        - header:   header to take voxel sizes and units from (optional)
+        - dtype:    numpy data type of the volume
+    Output:
+        - writable numpy memmap of the data in Fortran order, initialised
+          with zeros
+    """
+    if not fname.endswith('nii'):
+        raise ValueError('only uncompressed Nifti files can be memory-mapped')
+    hdr = _nifti_header(shape, affine, header, dtype)
+    with open(fname, 'wb') as fileobj:
+        hdr.write_to(fileobj)
+        n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        fileobj.truncate(hdr.get_data_offset() + n_bytes)
+    return np.memmap(fname, dtype=dtype, mode='r+', shape=tuple(shape),
+                     offset=hdr.get_data_offset(), order='F')
 
 
+@instrumented
+def save_volume_chunks(fname, chunks, shape, affine, header=None,
+                       dtype='float32'):
+    """
+    Function to write a Nifti volume chunk by chunk along its last axis, so
+    that the full data never has to be held in memory.
+    Input:
+        - fname:    filename ending in 'nii' or 'nii.gz'
+        - chunks:   iterable of numpy arrays, each with the shape of the
+                    volume except for the last axis, in the order they
+                    should be written
+        - shape:    shape of the full volume
+        - affine:   affine matrix
+        - header:   header to take voxel sizes and units from (optional)
+        - dtype:    numpy data type the data is written with
+    """
+    if not (fname.endswith('nii') or fname.endswith('nii.gz')):
+        raise ValueError('volume can only be streamed to Nifti files')
+    hdr = _nifti_header(shape, affine, header, dtype)
+
+    # in Fortran order the last axis varies slowest, so chunks along it are
+    # consecutive blocks of the file
+    n_written = 0
+    with nb.openers.Opener(fname, 'wb') as fileobj:
+        hdr.write_to(fileobj)
+        for chunk in chunks:
+            if chunk.shape[:-1] != tuple(shape[:-1]):
+                raise ValueError('chunk shape %s does not match volume shape '
+                                 '%s' % (chunk.shape, shape))
+            fileobj.write(np.asarray(chunk, dtype=dtype).tobytes(order='F'))
+            n_written += chunk.shape[-1]
+    if n_written != shape[-1]:
+        raise ValueError('%i of %i volumes were written to %s' %
+                         (n_written, shape[-1], fname))
+    count(bytes_written=os.path.getsize(fname))
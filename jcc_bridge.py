@@ -0,0 +1,93 @@
+import array
+import numpy as np
+from instrumentation import span
+from jvm import cbstools
+
+
+# typecodes of the Python arrays used as intermediate buffers. Their items
+# come back as plain Python numbers, which is what the JCC array
+# constructors accept, while the buffer itself stays at the Java width
+_TYPECODES = {'float': ('f', np.float32),
+              'double': ('d', np.float64),
+              'int': ('i', np.int32)}
+
+
+def to_jarray(data, jtype='float', order='F'):
+
+    '''
+    Passes a numpy array into the JVM as a flat Java array.
+
+    The array is flattened in the given order (Fortran order by default, as
+    expected by CBS Tools). For data that is already contiguous in that order
+    this is a view, so the only full copy made is the one into the Java
+    array. Data is never upcast beyond the width of the Java type.
+
+        Parameters
+        -----------
+        data : numpy array (any shape)
+        jtype : Java element type, one of 'float' (default), 'double', 'int'
+        order : Memory order in which the array is flattened, 'F' (default)
+            or 'C'
+
+        Returns
+        -------
+        cbstoolsjcc.JArray of the requested type
+    '''
+
+    typecode, dtype = _TYPECODES[jtype]
+    JArray = cbstools().JArray
+    with span('to_jarray') as s:
+        flat = np.ravel(data, order=order)
+        s.add(jni_bytes_to_java=flat.size * np.dtype(dtype).itemsize)
+
+        # float64 elements are Python floats already and can be read
+        # directly, everything else goes through a buffer of the Java width
+        if flat.dtype == np.float64 and dtype == np.float64:
+            return JArray(jtype)(flat)
+
+        flat = np.ascontiguousarray(flat, dtype=dtype)
+        buf = array.array(typecode)
+        if hasattr(buf, 'frombytes'):
+            buf.frombytes(flat.data)
+        else:
+            buf.fromstring(flat.data)
+        return JArray(jtype)(buf)
+
+
+def from_jarray(jarray, shape, dtype=np.float32, order='F'):
+
+    '''
+    Reads a flat Java array back into a numpy array, copying it out of the
+    JVM in a single call rather than element by element.
+
+        Parameters
+        -----------
+        jarray : cbstoolsjcc.JArray returned by one of the CBS Tools getters
+        shape : Shape of the output array
+        dtype : numpy dtype of the output array (default is float32)
+        order : Memory order of the Java array, 'F' (default) or 'C'
+
+        Returns
+        -------
+        numpy array of the given shape and dtype
+    '''
+
+    count = int(np.prod(shape))
+    dtype = np.dtype(dtype)
+    with span('from_jarray') as s:
+        # slicing copies the whole Java array in one JNI call, iterating
+        # would cross JNI once per element. Like in "to_jarray", the plain
+        # Python numbers go through a buffer of the output width
+        values = jarray[0:count]
+        if len(values) != count:
+            raise ValueError('Java array has %i elements, expected %i' %
+                             (len(values), count))
+        if dtype.kind == 'f':
+            typecode = 'd' if dtype.itemsize > 4 else 'f'
+        else:
+            typecode = 'l'
+        buf = array.array(typecode, values)
+        data = np.frombuffer(buf, dtype=buf.typecode).astype(dtype,
+                                                              copy=False)
+        s.add(jni_bytes_from_java=data.nbytes)
+        return np.reshape(data, shape, order=order)
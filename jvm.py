@@ -0,0 +1,278 @@
+import getpass
+import mmap
+import os
+import re
+import resource
+import struct
+import sys
+from collections import deque
+import threading
+import numpy as np
+from instrumentation import span
+
+
+# settings used when the JVM is started, see "configure_vm"
+_config = {'initialheap': '6000m', 'maxheap': '6000m', 'gc': None,
+           'gc_threads': None, 'vmargs': None, 'verbose': False}
+
+# number of memory reports kept, older ones are dropped
+MAX_REPORTS = 1000
+
+# heap sizes and memory reports of the running JVM
+_state = {'heap': None, 'reports': deque(maxlen=MAX_REPORTS), 'heap_peak': 0,
+          'perfdata': None}
+
+# serialises the start of the JVM by wrapper calls in several threads
+_lock = threading.Lock()
+
+# heap counters of the JVM performance data, in bytes
+_HEAP_COUNTER = re.compile(br'^sun\.gc\.generation\.\d+\.space\.\d+\.'
+                           br'(used|capacity)$')
+
+
+def cbstools():
+
+    '''
+    Imports and returns the cbstoolsjcc module. It loads libjvm, so it is
+    only imported by the code paths of the 'cbstools' backend and the
+    'numpy' backend works on machines without Java.
+    '''
+
+    import cbstoolsjcc
+    return cbstoolsjcc
+
+
+def _vm_env():
+    # JCC environment of the running JVM, None if cbstoolsjcc has not been
+    # imported, in which case the JVM cannot be running
+    module = sys.modules.get('cbstoolsjcc')
+    return module.getVMEnv() if module is not None else None
+
+
+def configure_vm(initialheap=None, maxheap=None, gc=None, gc_threads=None,
+                 vmargs=None, verbose=None):
+
+    '''
+    Sets the options with which the JVM will be started by the first call to
+    a CBS Tools wrapper. Has no effect once the JVM is running, since there
+    can only be one JVM per process.
+
+        Parameters
+        -----------
+        initialheap : Initial heap size as a Java size string (e.g. '2g').
+            The default is to use the maximum heap size.
+        maxheap : Maximum heap size as a Java size string (e.g. '2g'), or
+            'auto' to estimate it from the dimensions of the first input
+            volume with "estimate_heap". Default is '6000m'.
+        gc : Garbage collector, e.g. 'G1' or 'Parallel' (default is the JVM
+            default)
+        gc_threads : Number of parallel garbage collection threads
+        vmargs : List of additional JVM options
+        verbose : Whether memory usage should be printed after each stage
+            (default is 'False')
+    '''
+
+    if _vm_env() is not None:
+        print("The JVM is already running, options are not changed.")
+        return
+    if maxheap is not None:
+        _config['maxheap'] = maxheap
+        _config['initialheap'] = initialheap
+    elif initialheap is not None:
+        _config['initialheap'] = initialheap
+    for key, value in (('gc', gc), ('gc_threads', gc_threads),
+                       ('vmargs', vmargs), ('verbose', verbose)):
+        if value is not None:
+            _config[key] = value
+
+
+def estimate_heap(shape, n_layers=10):
+
+    '''
+    Estimates the Java heap needed for the layering pipeline on a volume.
+
+    The largest stage is "layering", which holds both input levelsets, the
+    depth and layer images, n_layers + 1 boundary levelsets and about a
+    dozen float work images of the same size.
+
+        Parameters
+        -----------
+        shape : Dimensions of the volume (only the first three are used)
+        n_layers : Number of layers that will be created (default is 10)
+
+        Returns
+        -------
+        Heap size as a Java size string in megabytes
+    '''
+
+    n_voxels = int(np.prod(shape[:3]))
+    n_volumes = 16 + n_layers + 1
+    megabytes = 4. * n_voxels * n_volumes / 2 ** 20
+    return '%im' % (256 + int(np.ceil(1.25 * megabytes)))
+
+
+def start_vm(shape=None, n_layers=None):
+
+    '''
+    Starts the JVM with the configured options unless it is running already,
+    and attaches the calling thread to it. Every wrapper calls this before
+    using CBS Tools, so it is only needed directly when CBS Tools classes
+    are used from other threads. Calls from several threads at once start
+    a single JVM.
+
+        Parameters
+        -----------
+        shape : Dimensions of the input volume, used if the heap size is set
+            to 'auto'
+        n_layers : Number of layers the heap is estimated for (see
+            "estimate_heap"). Default is taken from the fourth dimension of
+            a 4D boundary image, otherwise 10.
+
+        Returns
+        -------
+        JCC environment of the JVM
+    '''
+
+    with _lock:
+        cbstoolsjcc = cbstools()
+        env = cbstoolsjcc.getVMEnv()
+        if env is not None:
+            env.attachCurrentThread()
+            return env
+
+        maxheap = _config['maxheap']
+        if maxheap == 'auto':
+            if shape is None:
+                raise ValueError("The heap size is set to 'auto' but no "
+                                 "volume dimensions were given to estimate "
+                                 "it from")
+            if n_layers is None:
+                n_layers = shape[3] - 1 if len(shape) > 3 else 10
+            maxheap = estimate_heap(shape, n_layers)
+        initialheap = _config['initialheap'] or maxheap
+
+        vmargs = list(_config['vmargs'] or [])
+        if _config['gc']:
+            vmargs.append('-XX:+Use%sGC' % _config['gc'])
+        if _config['gc_threads']:
+            vmargs.append('-XX:ParallelGCThreads=%i' % _config['gc_threads'])
+
+        with span('start_vm', maxheap=maxheap):
+            env = cbstoolsjcc.initVM(initialheap=initialheap,
+                                     maxheap=maxheap,
+                                     vmargs=','.join(vmargs) or None)
+        _state['heap'] = (initialheap, maxheap)
+        return env
+
+
+def _perf_counters():
+    # maps the performance data file the JVM of this process writes (the
+    # source of jstat) and finds the heap counters in it, None if there is
+    # no such file, e.g. before the JVM started or with -XX:-UsePerfData
+    if _state['perfdata'] is None:
+        if _vm_env() is None:
+            return None
+        try:
+            # the JVM always uses /tmp on Linux, whatever TMPDIR is set to
+            fname = os.path.join('/tmp', 'hsperfdata_' + getpass.getuser(),
+                                 str(os.getpid()))
+            with open(fname, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        if struct.unpack('>I', data[:4])[0] != 0xcafec0c0:
+            return None
+        order = '<' if bytearray(data[4:5])[0] == 1 else '>'
+        entry, n_entries = struct.unpack(order + 'ii', data[24:32])
+        counters = []
+        for i in range(n_entries):
+            length, name, vector, dtype, _, _, _, offset = \
+                struct.unpack(order + 'iiiBBBBi', data[entry:entry + 20])
+            name = data[entry + name:data.find(b'\0', entry + name)]
+            match = _HEAP_COUNTER.match(name)
+            if match and vector == 0 and dtype == ord('J'):
+                counters.append((match.group(1), entry + offset))
+            entry += length
+        _state['perfdata'] = (data, order, counters)
+    return _state['perfdata']
+
+
+def heap_usage():
+
+    '''
+    Reads the used and committed Java heap of the running JVM from its
+    performance counters, which the JVM updates after each garbage
+    collection and every 50 ms. The peak is the largest use seen by any call
+    so far, so it is a lower bound of the true high-water mark.
+
+        Returns
+        -------
+        Dictionary with 'heap_used_mb', 'heap_committed_mb' and
+        'heap_peak_mb', or None if the JVM is not running or does not write
+        performance data
+    '''
+
+    perfdata = _perf_counters()
+    if perfdata is None:
+        return None
+    data, order, counters = perfdata
+    total = {'used': 0, 'capacity': 0}
+    for kind, offset in counters:
+        total[kind] += struct.unpack(order + 'q', data[offset:offset + 8])[0]
+    _state['heap_peak'] = max(_state['heap_peak'], total['used'])
+    return {'heap_used_mb': total['used'] / 2. ** 20,
+            'heap_committed_mb': total['capacity'] / 2. ** 20,
+            'heap_peak_mb': _state['heap_peak'] / 2. ** 20}
+
+
+def memory_usage(stage=None):
+
+    '''
+    Reports the memory used by the process, which includes the Java heap,
+    and the heap usage inside the JVM (see "heap_usage") alongside the
+    configured heap sizes.
+
+        Parameters
+        -----------
+        stage : Name of the stage the report is recorded for. If given, the
+            report is added to the list returned by "memory_reports", which
+            keeps the last MAX_REPORTS reports.
+
+        Returns
+        -------
+        Dictionary with the stage, the current and peak resident memory of
+        the process in MB, the initial and maximum heap size of the JVM and
+        the entries of "heap_usage" (None if not available)
+    '''
+
+    rss = 0.
+    try:
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        pass
+    report = {'stage': stage,
+              'rss_mb': rss / 2. ** 20,
+              'peak_rss_mb':
+                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+              'initialheap': _state['heap'] and _state['heap'][0],
+              'maxheap': _state['heap'] and _state['heap'][1]}
+    report.update(heap_usage() or dict.fromkeys(
+        ('heap_used_mb', 'heap_committed_mb', 'heap_peak_mb')))
+    if stage is not None:
+        _state['reports'].append(report)
+        if _config['verbose']:
+            print("%s: %.0f MB resident, %.0f MB peak, JVM heap %s" %
+                  (stage, report['rss_mb'], report['peak_rss_mb'],
+                   report['maxheap']))
+    return report
+
+
+def memory_reports():
+
+    '''
+    Returns the list of the last MAX_REPORTS memory reports recorded after
+    each stage.
+    '''
+
+    return list(_state['reports'])
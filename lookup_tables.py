@@ -0,0 +1,46 @@
+import os
+
+
+# lookup tables shipped with the package, with the trailing separator that
+# CBS Tools expects
+LUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'lookuptables', '')
+
+# table used by the levelset evolution for each topology, 'no' uses none
+TOPOLOGY_LUTS = {'26/6': 'critical266LUT', '6/26': 'critical626LUT',
+                 '18/6': 'critical186LUT', '6/18': 'critical618LUT',
+                 '6/6': 'critical66LUT', 'wcs': 'criticalWCLUT',
+                 'wco': 'criticalWCLUT', 'no': None}
+
+# topology CBS Tools uses if none is set
+DEFAULT_TOPOLOGY = 'wcs'
+
+
+def topology_lut(topology=None, lut_dir=None):
+
+    '''
+    Path of the lookup table the levelset evolution loads for a topology.
+
+        Parameters
+        -----------
+        topology : Topology constraint, one of the keys of TOPOLOGY_LUTS.
+            Default is the CBS Tools default 'wcs'.
+        lut_dir : Directory with the lookup tables, default is LUT_DIR
+
+        Returns
+        -------
+        Path of the '.raw.gz' table, None for topology 'no'
+    '''
+
+    topology = topology or DEFAULT_TOPOLOGY
+    if topology not in TOPOLOGY_LUTS:
+        raise ValueError('topology must be one of %s' %
+                         ', '.join(sorted(TOPOLOGY_LUTS)))
+    if TOPOLOGY_LUTS[topology] is None:
+        return None
+    fname = os.path.join(lut_dir or LUT_DIR, TOPOLOGY_LUTS[topology] +
+                         '.raw.gz')
+    if not os.path.isfile(fname):
+        raise IOError('lookup table %s for topology %s not found' %
+                      (fname, topology))
+    return fname
@@ -1,31 +1,125 @@
-def sample_volume(nii_file, vertices):
-    '''Samples volumetric data on surface mesh vertices'''
-    import numpy as np
-    import nibabel as nb
-    img = nb.load(nii_file)
-#    img=image
-    affine = img.get_affine()
-    data = img.get_data()
-    # for each vertex in the highres mesh find voxel it maps to
-    dim = [affine[0, 0], affine[1, 1], affine[2, 2]]
-    # might require -dim if axes are flipped. Consider try
-    idx = np.asarray(np.round(vertices / dim), dtype='int64')
-    data_mesh = data[idx[:, 0], idx[:, 1], idx[:, 2]]
-    return data_mesh;
+import numpy as np
+from scipy import sparse
+from io_volume import load_volume, load_data
 
-def generate_profiles(volumes, vertices):
-    '''Creates intensity profiles for vertex coordinates in 4D volume'''
-    import numpy as np
-    n_samples=np.shape(volumes.get_data())[3]
-    intensity_profiles=np.zeros([len(vertices),n_samples])
-    affine = volumes.get_affine()
-    dim = [affine[0, 0], affine[1, 1], affine[2, 2]]
-    idx = np.asarray(np.round(vertices / dim), dtype='int64')
-    for volume in range(n_samples):
-        data = volumes.get_data()[:,:,:,volume]
-        data_mesh = data[idx[:, 0], idx[:, 1], idx[:, 2]]
-        intensity_profiles[:,volume]=data_mesh[:]
-    return intensity_profiles;
+
+def sampling_weights(vertices, affine, shape, order=1, chunk_size=100000):
+    '''Precomputes the interpolation of a volume at vertex coordinates
+
+    Vertices are mapped into voxel space with the full inverse affine, so
+    translation, flips and oblique orientations are taken into account.
+    The result can be reused for any number of volumes with the same grid,
+    sampling them is a sparse matrix product (see "sample_volume").
+
+    Parameters
+    ----------
+    vertices : array (n_vertices, 3) of world coordinates
+    affine : 4x4 voxel to world affine of the volumes
+    shape : dimensions of the volumes (only the first three are used)
+    order : 1 (default) for trilinear, 0 for nearest neighbour interpolation
+    chunk_size : number of vertices processed at once to bound memory
+
+    Returns
+    -------
+    scipy.sparse CSR matrix (n_vertices, n_voxels) applying to volumes
+    flattened in Fortran order. Vertices outside the volume take the value
+    of the nearest voxel at the border.
+    '''
+    shape = np.asarray(shape[:3])
+    n_vertices = len(vertices)
+    inv = np.linalg.inv(affine)
+    strides = np.array([1, shape[0], shape[0] * shape[1]])
+    if order == 0:
+        corners = np.zeros((1, 3), dtype=int)
+    elif order == 1:
+        corners = np.array([[i, j, k] for i in (0, 1) for j in (0, 1)
+                            for k in (0, 1)])
+    else:
+        raise ValueError('order must be 0 or 1')
+
+    rows, cols, weights = [], [], []
+    for start in range(0, n_vertices, chunk_size):
+        chunk = np.asarray(vertices[start:start + chunk_size], dtype=float)
+        vox = chunk.dot(inv[:3, :3].T) + inv[:3, 3]
+        if order == 0:
+            base = np.clip(np.round(vox), 0, shape - 1).astype(int)
+            frac = np.zeros(vox.shape)
+        else:
+            base = np.clip(np.floor(vox), 0, np.maximum(shape - 2, 0))
+            frac = np.clip(vox - base, 0, 1)
+            base = base.astype(int)
+        vertex_idx = np.arange(start, start + len(chunk))
+        for corner in corners:
+            w = np.prod(np.where(corner, frac, 1 - frac), axis=1)
+            idx = np.minimum(base + corner, shape - 1)
+            rows.append(vertex_idx)
+            cols.append(idx.dot(strides))
+            weights.append(w)
+    return sparse.csr_matrix((np.concatenate(weights),
+                              (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n_vertices, int(np.prod(shape))))
+
+
+def sample_volume(nii_file, vertices, affine=None, order=1, weights=None,
+                  memory_limit=1000.):
+    '''Samples volumetric data on surface mesh vertices
+
+    Parameters
+    ----------
+    nii_file : 3D or 4D volume, path or Nibabel image object
+    vertices : array (n_vertices, 3) of world coordinates
+    affine : affine mapping voxel to vertex coordinates. Default is the
+        affine of the volume. For vertices in voxel space scaled by the voxel
+        sizes (e.g. meshes from CBS Tools), pass np.diag(zooms + [1]).
+    order : 1 (default) for trilinear, 0 for nearest neighbour interpolation
+    weights : interpolation weights from "sampling_weights" to reuse instead
+        of computing them
+    memory_limit : approximate memory in MB for the volumes of a 4D file
+        read at once (default is 1000). Each read of a compressed file
+        decompresses it from the start, so larger chunks mean fewer passes.
+
+    Returns
+    -------
+    array (n_vertices,) for 3D volumes, (n_vertices, n_volumes) for 4D
+    '''
+    img = load_volume(nii_file)
+    if weights is None:
+        if affine is None:
+            affine = img.get_affine()
+        weights = sampling_weights(vertices, affine, img.shape, order)
+    n_voxels = weights.shape[1]
+    if len(img.shape) == 3:
+        data = load_data(img, np.float32)
+        return weights.dot(data.reshape(n_voxels, order='F'))
+    # read chunks of volumes that fit into memory_limit with one slice each
+    # and sample all volumes of a chunk in one sparse matrix product
+    n_volumes = img.shape[3]
+    volume_size = 4. * n_voxels * np.prod(img.shape[4:])
+    chunk_size = max(int(memory_limit * 2 ** 20 // volume_size), 1)
+    samples = np.empty((len(vertices),) + img.shape[3:])
+    for start in range(0, n_volumes, chunk_size):
+        stop = min(start + chunk_size, n_volumes)
+        data = load_data(img, np.float32, volumes=slice(start, stop))
+        samples[:, start:stop] = weights.dot(
+            data.reshape(n_voxels, -1, order='F')).reshape(
+                samples[:, start:stop].shape, order='F')
+    return samples
+
+
+def generate_profiles(volumes, vertices, affine=None, order=1, weights=None,
+                      memory_limit=1000.):
+    '''Creates intensity profiles for vertex coordinates in 4D volume
+
+    The interpolation weights are computed once and applied to chunks of
+    volumes as they are read, see "sample_volume" for the parameters.
+
+    Returns
+    -------
+    array (n_vertices, n_volumes)
+    '''
+    profiles = sample_volume(volumes, vertices, affine, order, weights,
+                             memory_limit)
+    return profiles.reshape(len(profiles), -1)
 
 def convert_mesh_voxel2mipav(mesh,volume):
     '''converts mesh coordinates from voxelspace to mipav space'''
@@ -0,0 +1,422 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from scipy import ndimage
+
+# version of the algorithms in this module, part of the cache key of results
+VERSION = '0.1'
+
+
+def _axis_slices(ndim, axis):
+    # slices selecting the lower and upper voxel of each neighbour pair
+    # along one axis
+    lower = [slice(None)] * ndim
+    upper = [slice(None)] * ndim
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    return tuple(lower), tuple(upper)
+
+
+def probability_to_levelset(prob_data, zooms, threshold=0.5):
+
+    '''
+    Signed distance levelset of the surface where a probability map crosses
+    a threshold, computed with Euclidean distance transforms.
+
+    Voxels next to the surface get their distance from the sub-voxel
+    position of the threshold crossing along each axis (linear
+    interpolation of the probabilities). All other voxels get the distance
+    to the nearest such voxel plus that voxel's own distance.
+
+        Parameters
+        -----------
+        prob_data : 3D numpy array, probability or binary mask with high
+            values inside the surface
+        zooms : Voxel sizes along the three axes (in mm)
+        threshold : Value at which the surface is placed (default is 0.5)
+
+        Returns
+        -------
+        3D float32 numpy array, negative inside and positive outside the
+        surface (in mm)
+    '''
+
+    prob = np.asarray(prob_data, dtype=np.float32)
+    zooms = [float(z) for z in zooms[:3]]
+    inside = prob >= threshold
+
+    # the nearest crossing along each axis, combined over axes as the
+    # distance to the plane through these crossings
+    inv_sq = np.zeros(prob.shape, dtype=np.float32)
+    for axis in range(3):
+        axis_inv = np.zeros(prob.shape, dtype=np.float32)
+        lower, upper = _axis_slices(3, axis)
+        cross = inside[lower] != inside[upper]
+        p0 = prob[lower][cross]
+        p1 = prob[upper][cross]
+        frac = np.clip((p0 - threshold) / (p0 - p1), 0, 1)
+        for sl, dist in ((lower, frac), (upper, 1 - frac)):
+            dist = np.maximum(dist * zooms[axis], 1e-6)
+            view = axis_inv[sl]
+            view[cross] = np.maximum(view[cross], 1. / dist ** 2)
+        inv_sq += axis_inv
+    band = inv_sq > 0
+    if not band.any():
+        raise ValueError('The probability image does not cross the threshold,'
+                         ' there is no surface to create a levelset from')
+    band_dist = np.zeros(prob.shape, dtype=np.float32)
+    band_dist[band] = 1. / np.sqrt(inv_sq[band])
+    del inv_sq
+
+    levelset = np.empty(prob.shape, dtype=np.float32)
+    indices = np.empty((3,) + prob.shape, dtype=np.int32)
+    for side, sign in ((inside, -1), (~inside, 1)):
+        seeds = band & side
+        if not seeds.any():
+            seeds = band
+        dist = ndimage.distance_transform_edt(~seeds, sampling=zooms,
+                                              return_indices=True,
+                                              indices=indices)
+        nearest = band_dist[indices[0], indices[1], indices[2]]
+        levelset[side] = sign * (dist[side] + nearest[side])
+
+    return levelset
+
+
+def _map_slabs(func, arrays, halo, n_jobs=1):
+    # applies func to slabs of the arrays along the last axis, each padded
+    # with a halo of neighbouring voxels, and stitches the results
+    length = arrays[0].shape[-1]
+    n_slabs = max(min(n_jobs, length), 1)
+    edges = np.linspace(0, length, n_slabs + 1).astype(int)
+
+    def run(i):
+        start = max(edges[i] - halo, 0)
+        stop = min(edges[i + 1] + halo, length)
+        result = func(*[a[..., start:stop] for a in arrays])
+        return result[..., edges[i] - start:edges[i + 1] - start]
+
+    if n_slabs == 1:
+        return run(0)
+    pool = ThreadPool(n_slabs)
+    try:
+        slabs = pool.map(run, range(n_slabs))
+    finally:
+        pool.close()
+    return np.concatenate(slabs, axis=-1)
+
+
+def levelset_curvature(levelset, zooms, smoothing=1.):
+
+    '''
+    Mean curvature (sum of the principal curvatures) of the isosurfaces of a
+    levelset, computed as the divergence of its normalized gradient.
+
+        Parameters
+        -----------
+        levelset : 3D numpy array
+        zooms : Voxel sizes along the three axes (in mm)
+        smoothing : Standard deviation in voxels of the Gaussian applied to
+            the levelset before differentiation (default is 1, 0 for none)
+
+        Returns
+        -------
+        3D float32 numpy array, positive where the surface is convex (e.g.
+        2/R on a sphere of radius R with negative levelset inside)
+    '''
+
+    levelset = np.asarray(levelset, dtype=np.float32)
+    if smoothing > 0:
+        levelset = ndimage.gaussian_filter(levelset, smoothing)
+    grads = np.gradient(levelset, *zooms[:3])
+    norm = np.sqrt(sum(g ** 2 for g in grads)) + 1e-6
+    curvature = np.zeros(levelset.shape, dtype=np.float32)
+    for axis in range(3):
+        curvature += np.gradient(grads[axis] / norm, zooms[axis], axis=axis)
+    return curvature
+
+
+def depth_halo(smoothing=1.):
+
+    '''
+    Number of voxels around a voxel that its depth from
+    "equivolumetric_depth" depends on: the radius of the Gaussian and of the
+    finite differences of the curvature. Cropped volumes or slabs that extend
+    this far beyond the cortex give the same depth as the full volume.
+    '''
+
+    return int(np.ceil(4 * smoothing)) + 2
+
+
+def equivolumetric_depth(gwb_data, cgb_data, zooms, smoothing=1., n_jobs=1):
+
+    '''
+    Continuous equivolumetric depth of the cortex between two levelsets.
+
+    Follows the model of Waehnert et al. (2014): along a profile the surface
+    area changes linearly between the inner area A_in and the outer area
+    A_out, and the volume fraction alpha at relative distance rho is
+    ((A_in + rho (A_out - A_in))^2 - A_in^2) / (A_out^2 - A_in^2). The area
+    ratio is estimated for each voxel from the curvature of both levelsets
+    in a locally spherical approximation, so no iterative evolution is
+    needed.
+
+    This is an approximation of LaminarVolumetricLayering, not a port of its
+    volume-preserving levelset evolution. It is exact for spherical shells
+    up to discretisation (within 0.01 at 1 mm voxels) but ignores the
+    topology constraint, and where the curvature changes quickly across the
+    cortex the depth can differ from CBS Tools (see the tests for the
+    tolerances checked).
+
+        Parameters
+        -----------
+        gwb_data : 3D numpy array, levelset of the GM/WM surface
+        cgb_data : 3D numpy array, levelset of the CSF/GM surface
+        zooms : Voxel sizes along the three axes (in mm)
+        smoothing : Gaussian smoothing in voxels before computing curvature
+            (default is 1)
+        n_jobs : Number of threads (default is 1)
+
+        Returns
+        -------
+        3D float32 numpy array with depth from 0 (WM) to 1 (CSF)
+    '''
+
+    halo = depth_halo(smoothing)
+
+    def slab_depth(gwb, cgb):
+        gwb = np.asarray(gwb, dtype=np.float32)
+        cgb = np.asarray(cgb, dtype=np.float32)
+        depth = (gwb >= 0).astype(np.float32)
+        cortex = (gwb >= 0) & (cgb <= 0)
+        if not cortex.any():
+            return depth
+
+        d_in = gwb[cortex]
+        d_out = -cgb[cortex]
+        thickness = np.maximum(d_in + d_out, 1e-6)
+        rho = d_in / thickness
+
+        # curvature of both boundary surfaces, extrapolated from the
+        # parallel surface through the voxel, and the resulting ratio of
+        # outer to inner area from either side
+        k_gwb = levelset_curvature(gwb, zooms, smoothing)[cortex] / 2
+        k_cgb = levelset_curvature(cgb, zooms, smoothing)[cortex] / 2
+        k_in = k_gwb / np.maximum(1 - k_gwb * d_in, 0.1)
+        k_out = k_cgb / np.maximum(1 + k_cgb * d_out, 0.1)
+        ratio_in = np.maximum(1 + k_in * thickness, 0.1) ** 2
+        ratio_out = 1. / np.maximum(1 - k_out * thickness, 0.1) ** 2
+        ratio = np.clip(np.sqrt(ratio_in * ratio_out), 0.05, 20)
+
+        alpha = rho.copy()
+        curved = np.abs(ratio - 1) > 1e-3
+        r = ratio[curved]
+        p = rho[curved]
+        alpha[curved] = ((1 + p * (r - 1)) ** 2 - 1) / (r ** 2 - 1)
+        depth[cortex] = np.clip(alpha, 0, 1)
+        return depth
+
+    return _map_slabs(slab_depth, [gwb_data, cgb_data], halo, n_jobs)
+
+
+def depth_to_layers(depth, gwb_data, cgb_data, n_layers):
+
+    '''
+    Discrete layers from a continuous depth map.
+
+        Parameters
+        -----------
+        depth : 3D numpy array with depth from 0 (WM) to 1 (CSF)
+        gwb_data : 3D numpy array, levelset of the GM/WM surface
+        cgb_data : 3D numpy array, levelset of the CSF/GM surface
+        n_layers : int, number of layers
+
+        Returns
+        -------
+        3D uint32 numpy array with layers from 1 (bordering WM) to n_layers
+        (bordering CSF) in the cortex and 0 outside
+    '''
+
+    cortex = (gwb_data >= 0) & (cgb_data <= 0)
+    return _cortex_layers(depth.shape, cortex, depth[cortex], n_layers)
+
+
+def depth_to_boundaries(depth, gwb_data, cgb_data, n_layers):
+
+    '''
+    Levelsets of the n_layers + 1 layer boundaries from a continuous depth
+    map, with the GM/WM and CSF/GM surfaces as first and last boundary.
+
+    Inside the cortex the levelset of the boundary at depth f is
+    (depth - f) times the local thickness, outside it is the linear blend
+    (1 - f) * gwb + f * cgb of the two input levelsets. Both agree on the
+    cortical surfaces, and the zero crossing is exactly at depth f.
+
+        Parameters
+        -----------
+        depth : 3D numpy array with depth from 0 (WM) to 1 (CSF)
+        gwb_data : 3D numpy array, levelset of the GM/WM surface
+        cgb_data : 3D numpy array, levelset of the CSF/GM surface
+        n_layers : int, number of layers
+
+        Returns
+        -------
+        4D float32 numpy array, the 4th dimension representing the
+        boundaries from WM to CSF
+    '''
+
+    cortex = (gwb_data >= 0) & (cgb_data <= 0)
+    return _cortex_boundaries(gwb_data, cgb_data, cortex, depth[cortex],
+                              (gwb_data - cgb_data)[cortex], n_layers)
+
+
+def _cortex_layers(shape, cortex, cortex_depth, n_layers):
+    # layers from the depth of the voxels in the cortex mask
+    layers = np.zeros(shape, dtype=np.uint32)
+    layers[cortex] = np.clip(np.ceil(cortex_depth * n_layers), 1, n_layers)
+    return layers
+
+
+def _cortex_boundaries(gwb_data, cgb_data, cortex, cortex_depth, thickness,
+                       n_layers):
+    # boundary levelsets from the depth and thickness of the voxels in the
+    # cortex mask, see "depth_to_boundaries"
+    boundaries = np.empty(gwb_data.shape + (n_layers + 1,), dtype=np.float32,
+                          order='F')
+    for i in range(n_layers + 1):
+        frac = i / float(n_layers)
+        boundary = boundaries[..., i]
+        np.multiply(gwb_data, 1 - frac, out=boundary)
+        boundary += frac * cgb_data
+        boundary[cortex] = (cortex_depth - frac) * thickness
+    return boundaries
+
+
+def relayer_depth(depth, gwb_data, cgb_data, n_layers_list, layers=True,
+                  boundaries=True):
+
+    '''
+    Layers and boundary levelsets for several numbers of layers from one
+    continuous depth map, as "depth_to_layers" and "depth_to_boundaries".
+    The cortex, its depth and thickness are extracted once for all of
+    them.
+
+        Parameters
+        -----------
+        depth : 3D numpy array with depth from 0 (WM) to 1 (CSF)
+        gwb_data : 3D numpy array, levelset of the GM/WM surface
+        cgb_data : 3D numpy array, levelset of the CSF/GM surface
+        n_layers_list : list of numbers of layers
+        layers, boundaries : whether to compute the layers and boundaries
+
+        Returns
+        -------
+        Generator of (n_layers, layers, boundaries) for each number of
+        layers in turn, with None for the arrays not computed
+    '''
+
+    cortex = (gwb_data >= 0) & (cgb_data <= 0)
+    cortex_depth = depth[cortex]
+    thickness = (gwb_data - cgb_data)[cortex] if boundaries else None
+    for n_layers in n_layers_list:
+        layer_data = boundary_data = None
+        if layers:
+            layer_data = _cortex_layers(depth.shape, cortex, cortex_depth,
+                                        n_layers)
+        if boundaries:
+            boundary_data = _cortex_boundaries(gwb_data, cgb_data, cortex,
+                                               cortex_depth, thickness,
+                                               n_layers)
+        yield n_layers, layer_data, boundary_data
+
+
+def levelset_positions(boundary_data, zooms, points, n_iterations=5):
+
+    '''
+    Moves points onto each of a series of levelsets. Each levelset is
+    reached from the position on the previous one (the first from the
+    points themselves) by Newton steps along its gradient,
+    x - phi(x) grad(phi) / |grad(phi)|^2, with trilinear interpolation of
+    the levelset and its gradient. All points are moved at once.
+
+        Parameters
+        -----------
+        boundary_data : 4D numpy array, levelsets of the layer boundaries
+            from WM (first) to CSF (last)
+        zooms : Voxel sizes along the three axes (in mm)
+        points : Array of shape (3, n_points) with voxel coordinates
+        n_iterations : Number of Newton steps per boundary (default is 5)
+
+        Returns
+        -------
+        float32 numpy array of shape (3, n_points, n_boundaries) with the
+        voxel coordinates on each boundary
+    '''
+
+    zooms = [float(z) for z in zooms[:3]]
+    n_boundaries = boundary_data.shape[3]
+    points = np.array(points, dtype=np.float32)
+    positions = np.empty(points.shape + (n_boundaries,), dtype=np.float32)
+
+    for i in range(n_boundaries):
+        levelset = np.asarray(boundary_data[..., i], dtype=np.float32)
+        # gradients in mm per mm, the steps are then scaled to voxels
+        grads = np.gradient(levelset, *zooms)
+        for _ in range(n_iterations):
+            phi = ndimage.map_coordinates(levelset, points, order=1,
+                                          mode='nearest')
+            g = [ndimage.map_coordinates(grad, points, order=1,
+                                         mode='nearest') for grad in grads]
+            step = phi / np.maximum(sum(c ** 2 for c in g), 1e-6)
+            for axis in range(3):
+                points[axis] -= step * g[axis] / zooms[axis]
+        positions[..., i] = points
+    return positions
+
+
+def profile_positions(boundary_data, zooms, n_iterations=5):
+
+    '''
+    Positions at which the profile of each cortical voxel crosses the layer
+    boundaries, see "levelset_positions".
+
+        Parameters
+        -----------
+        boundary_data : 4D numpy array, levelsets of the layer boundaries
+            from WM (first) to CSF (last)
+        zooms : Voxel sizes along the three axes (in mm)
+        n_iterations : Number of Newton steps per boundary (default is 5)
+
+        Returns
+        -------
+        Tuple of a 3D boolean numpy array marking the cortical voxels and a
+        float32 numpy array of shape (3, n_voxels, n_boundaries) with the
+        voxel coordinates of the profile positions, the voxels ordered as in
+        "numpy.nonzero" of the mask
+    '''
+
+    mask = (boundary_data[..., 0] >= 0) & (boundary_data[..., -1] <= 0)
+    positions = levelset_positions(boundary_data, zooms, np.nonzero(mask),
+                                   n_iterations)
+    return mask, positions
+
+
+def sample_profiles(intensity_data, positions):
+
+    '''
+    Samples a 3D volume at profile positions with trilinear interpolation.
+
+        Parameters
+        -----------
+        intensity_data : 3D numpy array
+        positions : Voxel coordinates as returned by "profile_positions"
+
+        Returns
+        -------
+        float32 numpy array of shape (n_voxels, n_boundaries)
+    '''
+
+    flat = positions.reshape(3, -1)
+    values = ndimage.map_coordinates(np.asarray(intensity_data,
+                                                dtype=np.float32),
+                                     flat, order=1, mode='nearest')
+    return values.reshape(positions.shape[1:])
@@ -0,0 +1,41 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import nibabel as nb
+
+# the modules import each other by name from the package directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def sphere(shape=40, r_in=8., r_out=14.):
+    # binary masks and signed distances of two concentric spheres in 1 mm
+    # voxels, negative inside
+    centre = (shape - 1) / 2.
+    x, y, z = np.mgrid[:shape, :shape, :shape] - centre
+    r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+
+    def image(data):
+        return nb.Nifti1Image(np.asfortranarray(data, dtype=np.float32),
+                              np.eye(4))
+    return {'gwb_prob': image(r <= r_in), 'cgb_prob': image(r <= r_out),
+            'gwb_levelset': image(r - r_in), 'cgb_levelset': image(r - r_out)}
+
+
+def has_jvm():
+    try:
+        import cbstoolsjcc
+    except ImportError:
+        return False
+    return True
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,23 @@
+import unittest
+import numpy as np
+from common import sphere
+from volumetric_layering import layering
+
+
+class CropTest(unittest.TestCase):
+
+    def test_cropped_layering_matches_full_run(self):
+        # the cortex fills half of the field of view
+        data = sphere(shape=60)
+        gwb, cgb = data['gwb_levelset'], data['cgb_levelset']
+        full = layering(gwb, cgb, n_layers=5, save_data=False,
+                        backend='numpy')
+        cropped = layering(gwb, cgb, n_layers=5, save_data=False,
+                           backend='numpy', crop=True, crop_margin=1.)
+        for a, b in zip(cropped, full):
+            np.testing.assert_array_equal(np.asarray(a.dataobj),
+                                          np.asarray(b.dataobj))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import timeit
+import unittest
+import numpy as np
+import common  # puts the package directory on the path
+from jcc_bridge import from_jarray
+
+
+class CountingJArray(object):
+    # stands in for a JCC array: every index or slice access is one JNI call
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.calls = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        self.calls += 1
+        return self.values[index]
+
+
+class FromJarrayTest(unittest.TestCase):
+
+    def test_single_jni_call(self):
+        data = np.random.rand(20, 30, 40).astype(np.float32)
+        jarray = CountingJArray(data.ravel(order='F').tolist())
+        result = from_jarray(jarray, data.shape)
+        self.assertEqual(jarray.calls, 1)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_array_equal(result, data)
+
+    def test_dtypes_and_order(self):
+        data = np.arange(24, dtype=np.uint32).reshape(2, 3, 4)
+        result = from_jarray(CountingJArray(data.ravel().tolist()),
+                             data.shape, dtype=np.uint32, order='C')
+        self.assertEqual(result.dtype, np.uint32)
+        np.testing.assert_array_equal(result, data)
+        result = from_jarray(CountingJArray([0.5] * 6), (2, 3),
+                             dtype=np.float64)
+        self.assertEqual(result.dtype, np.float64)
+
+    def test_size_mismatch(self):
+        self.assertRaises(ValueError, from_jarray,
+                          CountingJArray([1., 2.]), (3,))
+
+    def test_faster_than_element_wise(self):
+        # reading element by element, as the previous np.fromiter did
+        values = CountingJArray(np.random.rand(200000).tolist())
+        bulk = min(timeit.repeat(lambda: from_jarray(values, (200000,)),
+                                 number=1, repeat=3))
+        element_wise = min(timeit.repeat(
+            lambda: np.fromiter((values[i] for i in xrange(len(values))),
+                                dtype=np.float32, count=len(values)),
+            number=1, repeat=3))
+        self.assertLess(bulk * 5, element_wise)
+
+
+if __name__ == '__main__':
+    unittest.main()
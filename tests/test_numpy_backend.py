@@ -0,0 +1,48 @@
+import os
+import unittest
+import numpy as np
+from common import sphere, has_jvm
+from numpy_backend import equivolumetric_depth
+from volumetric_layering import create_levelsets, layering
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data')
+
+
+class EquivolumetricDepthTest(unittest.TestCase):
+
+    def test_sphere_depth_within_tolerance(self):
+        # exact equivolumetric depth of a spherical shell
+        data = sphere(shape=60, r_in=8., r_out=14.)
+        gwb = np.asarray(data['gwb_levelset'].dataobj)
+        cgb = np.asarray(data['cgb_levelset'].dataobj)
+        depth = equivolumetric_depth(gwb, cgb, [1., 1., 1.])
+        r = gwb + 8.
+        exact = (r ** 3 - 8. ** 3) / (14. ** 3 - 8. ** 3)
+        cortex = (gwb > 0) & (cgb < 0)
+        self.assertLess(np.abs(depth - exact)[cortex].max(), 0.02)
+
+    @unittest.skipUnless(has_jvm(), 'CBS Tools needs a JVM')
+    def test_close_to_cbstools_on_bundled_data(self):
+        # the closed form approximates the levelset evolution of CBS Tools:
+        # depth within 0.05 on average and layers at most one apart in 95%
+        # of the cortex
+        levelsets = [create_levelsets(
+            os.path.join(DATA_DIR, 'adult_F04_%s_orig_binmask.nii.gz' % name),
+            save_data=False, backend='numpy') for name in ('intern', 'extern')]
+        results = [layering(levelsets[0], levelsets[1], n_layers=6,
+                            save_data=False, backend=backend,
+                            outputs=('depth', 'layers'))
+                   for backend in ('numpy', 'cbstools')]
+        gwb = np.asarray(levelsets[0].dataobj)
+        cgb = np.asarray(levelsets[1].dataobj)
+        cortex = (gwb >= 0) & (cgb <= 0)
+        depth = [np.asarray(r[0].dataobj)[cortex] for r in results]
+        layers = [np.asarray(r[1].dataobj)[cortex].astype(int)
+                  for r in results]
+        self.assertLess(np.abs(depth[0] - depth[1]).mean(), 0.05)
+        self.assertGreater(np.mean(np.abs(layers[0] - layers[1]) <= 1), 0.95)
+
+
+if __name__ == '__main__':
+    unittest.main()
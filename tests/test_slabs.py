@@ -0,0 +1,34 @@
+import os
+import unittest
+import numpy as np
+from common import sphere, TempDirTestCase
+from volumetric_layering import create_levelsets, layering
+
+
+class SlabTest(TempDirTestCase):
+
+    def test_levelset_is_full_run_clipped_to_halo(self):
+        prob = sphere()['cgb_prob']
+        full = create_levelsets(prob, save_data=False, backend='numpy')
+        stitched = create_levelsets(
+            prob, base_name=os.path.join(self.directory, 'slabs'),
+            backend='numpy', slab_size=7, slab_halo=5.)
+        np.testing.assert_array_equal(
+            np.asarray(stitched.dataobj),
+            np.clip(np.asarray(full.dataobj), -5, 5))
+
+    def test_layering_matches_full_run(self):
+        data = sphere()
+        full = layering(data['gwb_levelset'], data['cgb_levelset'],
+                        n_layers=4, save_data=False, backend='numpy')
+        stitched = layering(data['gwb_levelset'], data['cgb_levelset'],
+                            n_layers=4, backend='numpy', slab_size=7,
+                            slab_halo=9., n_jobs=2,
+                            base_name=os.path.join(self.directory, 'slabs'))
+        for a, b in zip(stitched, full):
+            np.testing.assert_array_equal(np.asarray(a.dataobj),
+                                          np.asarray(b.dataobj))
+
+
+if __name__ == '__main__':
+    unittest.main()
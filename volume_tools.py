@@ -0,0 +1,211 @@
+import numpy as np
+from scipy import ndimage
+
+
+def bounding_box(mask, margin=0):
+
+    '''
+    Finds the tight bounding box of the non-zero voxels in a mask.
+
+        Parameters
+        -----------
+        mask : 3D numpy array, voxels to be contained in the box are non-zero
+        margin : int or sequence of int, number of voxels to add on each side
+            of the box along each axis (default is 0). The box is clipped to
+            the array.
+
+        Returns
+        -------
+        Tuple of slices, one per axis, or None if the mask is empty
+    '''
+
+    margin = np.broadcast_to(margin, (mask.ndim,)).astype(int)
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        idx = np.flatnonzero(np.any(mask, axis=other))
+        if idx.size == 0:
+            return None
+        bbox.append(slice(max(idx[0] - margin[axis], 0),
+                          min(idx[-1] + 1 + margin[axis], mask.shape[axis])))
+    return tuple(bbox)
+
+
+def paste_volume(data, bbox, fill):
+
+    '''
+    Pastes data computed on a cropped sub-volume back into the full grid.
+
+        Parameters
+        -----------
+        data : numpy array computed on the cropped grid
+        bbox : Tuple of slices the data was cropped with
+        fill : numpy array on the full grid (extra dimensions of data
+            included) holding the values outside the box. It is modified
+            in place.
+
+        Returns
+        -------
+        The filled full-grid array
+    '''
+
+    fill[bbox] = data
+    return fill
+
+
+def boundary_voxels(mask):
+
+    '''
+    Marks the voxels of a binary mask that have a 6-neighbour of the other
+    label, i.e. the voxels on either side of the mask surface.
+
+        Parameters
+        -----------
+        mask : 3D boolean numpy array
+
+        Returns
+        -------
+        3D boolean numpy array
+    '''
+
+    boundary = np.zeros(mask.shape, dtype=bool)
+    for axis in range(mask.ndim):
+        lower = [slice(None)] * mask.ndim
+        upper = [slice(None)] * mask.ndim
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        change = mask[tuple(lower)] != mask[tuple(upper)]
+        boundary[tuple(lower)] |= change
+        boundary[tuple(upper)] |= change
+    return boundary
+
+
+def slab_slices(length, slab_size, halo):
+
+    '''
+    Splits an axis into slabs that are processed with a halo of neighbouring
+    voxels on either side.
+
+        Parameters
+        -----------
+        length : Number of voxels along the axis
+        slab_size : Number of voxels per slab (without halo)
+        halo : Number of voxels added on either side, clipped to the axis
+
+        Returns
+        -------
+        List of tuples of three slices: the slab with halo in the full
+        array, the slab without halo within the slab with halo, and the slab
+        without halo in the full array
+    '''
+
+    slab_size = max(int(slab_size), 1)
+    slabs = []
+    for start in range(0, length, slab_size):
+        stop = min(start + slab_size, length)
+        outer = slice(max(start - halo, 0), min(stop + halo, length))
+        slabs.append((outer,
+                      slice(start - outer.start, stop - outer.start),
+                      slice(start, stop)))
+    return slabs
+
+
+def label_dtype(n_labels):
+
+    '''
+    Smallest unsigned integer type that holds the labels 0 to n_labels.
+    '''
+
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n_labels <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def clip_band(data, band):
+
+    '''
+    Clips levelset values to a narrow band around the surfaces. The sign,
+    and thus which side of each surface a voxel lies on, is kept, while the
+    values beyond the band are lost.
+
+        Parameters
+        -----------
+        data : numpy array of levelset values, clipped in place if writable
+        band : Half width of the band in mm, None to keep all values
+
+        Returns
+        -------
+        Clipped array
+    '''
+
+    if band is None:
+        return data
+    if data.flags.writeable:
+        return np.clip(data, -band, band, out=data)
+    return np.clip(data, -band, band).astype(data.dtype)
+
+
+def downsample_data(data, factor):
+
+    '''
+    Downsamples a 3D array by averaging blocks of voxels. Arrays whose size
+    is not a multiple of the factor are padded with their edge values.
+
+        Parameters
+        -----------
+        data : 3D numpy array
+        factor : int or sequence of three ints, block size along each axis
+
+        Returns
+        -------
+        float32 numpy array with ceil(shape / factor) voxels
+    '''
+
+    factor = np.broadcast_to(factor, (3,)).astype(int)
+    coarse = -(-np.asarray(data.shape[:3]) // factor)
+    pad = [(0, c * f - n) for c, f, n in zip(coarse, factor, data.shape[:3])]
+    data = np.pad(np.asarray(data, dtype=np.float32), pad, mode='edge')
+    blocks = data.reshape(coarse[0], factor[0], coarse[1], factor[1],
+                          coarse[2], factor[2])
+    return blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+def downsample_affine(affine, factor):
+
+    '''
+    Affine of a volume downsampled with "downsample_data", whose voxel
+    centres lie at the centres of the blocks.
+    '''
+
+    factor = np.broadcast_to(factor, (3,)).astype(float)
+    affine = np.asarray(affine, dtype=float)
+    coarse = affine.copy()
+    coarse[:3, :3] = affine[:3, :3] * factor
+    coarse[:3, 3] = affine[:3, :3].dot((factor - 1) / 2.) + affine[:3, 3]
+    return coarse
+
+
+def upsample_data(data, factor, shape, order=1):
+
+    '''
+    Interpolates a 3D array downsampled with "downsample_data" back onto the
+    original grid.
+
+        Parameters
+        -----------
+        data : 3D numpy array on the coarse grid
+        factor : int or sequence of three ints it was downsampled by
+        shape : Shape of the original grid
+        order : 1 (default) for linear interpolation, 0 for nearest
+            neighbour, e.g. for labels
+
+        Returns
+        -------
+        numpy array of the given shape and the data type of data
+    '''
+
+    scale = 1. / np.broadcast_to(factor, (3,)).astype(float)
+    return ndimage.affine_transform(data, np.diag(scale), offset=(scale - 1) / 2.,
+                                    output_shape=tuple(shape[:3]),
+                                    order=order, mode='nearest')
@@ -2,13 +2,148 @@
 import argparse
 import numpy as np
 import nibabel as nb
-import cbstoolsjcc
 import os
-from io_volume import load_volume, save_volume
-from io_mesh import load_mesh_geometry, save_mesh_geometry
+from io_volume import load_volume, load_data, save_volume, \
+    save_volume_chunks, volume_memmap
+from io_mesh import load_mesh_geometry, save_mesh_geometry, \
+    save_layered_mesh
+from jcc_bridge import to_jarray, from_jarray
+from jvm import cbstools, start_vm, memory_usage
+import numpy_backend
+from numpy_backend import probability_to_levelset, equivolumetric_depth, \
+    depth_to_layers, depth_to_boundaries, relayer_depth, depth_halo
+from multiprocessing.pool import ThreadPool
+from volume_tools import bounding_box, boundary_voxels, paste_volume, \
+    slab_slices, label_dtype, clip_band, downsample_data, downsample_affine, \
+    upsample_data
+from cache import cache_enabled, cache_key, load_cached, store_cached, \
+    directory_hash
+from lookup_tables import LUT_DIR, topology_lut
+from instrumentation import instrumented, span
 
 
-def create_levelsets(tissue_prob_img, save_data=True, base_name=None):
+# outputs of "layering" in the order they are returned
+LAYERING_OUTPUTS = ('depth', 'layers', 'boundaries')
+
+
+def _backend_version(backend):
+    if backend == 'numpy':
+        return numpy_backend.VERSION
+    return cbstools().VERSION
+
+
+def _levelset_data(prob_data, zooms, backend):
+    # computes the levelset array with the chosen backend
+    if backend == 'numpy':
+        with span('execute', backend=backend):
+            return probability_to_levelset(prob_data, zooms)
+
+    start_vm(prob_data.shape)
+
+    prob2level = cbstools().SurfaceProbabilityToLevelset()
+
+    prob2level.setProbabilityImage(to_jarray(prob_data))
+    prob2level.setDimensions(prob_data.shape)
+    prob2level.setResolutions(zooms[0], zooms[1], zooms[2])
+    with span('execute', backend=backend):
+        prob2level.execute()
+
+    levelset_data = from_jarray(prob2level.getLevelSetImage(),
+                                prob_data.shape)
+    memory_usage('create_levelsets')
+    return levelset_data
+
+
+def _layering_data(gwb_data, cgb_data, zooms, n_layers, lut_dir, topology,
+                   backend, n_jobs, outputs=LAYERING_OUTPUTS):
+    # computes depth, layer and boundary arrays with the chosen backend, the
+    # arrays not in outputs are neither derived nor fetched and are None
+    depth_data = layer_data = boundary_data = None
+    if backend == 'numpy':
+        with span('execute', backend=backend):
+            depth = equivolumetric_depth(gwb_data, cgb_data, zooms,
+                                         n_jobs=n_jobs)
+            if 'layers' in outputs:
+                layer_data = depth_to_layers(depth, gwb_data, cgb_data,
+                                             n_layers)
+            if 'boundaries' in outputs:
+                boundary_data = depth_to_boundaries(depth, gwb_data,
+                                                    cgb_data, n_layers)
+        if 'depth' in outputs:
+            depth_data = depth
+        return depth_data, layer_data, boundary_data
+
+    start_vm(gwb_data.shape, n_layers)
+
+    lamination = cbstools().LaminarVolumetricLayering()
+    lamination.setDimensions(gwb_data.shape[0], gwb_data.shape[1],
+                             gwb_data.shape[2])
+    lamination.setResolutions(zooms[0], zooms[1], zooms[2])
+
+    lamination.setInnerDistanceImage(to_jarray(gwb_data))
+    lamination.setOuterDistanceImage(to_jarray(cgb_data))
+    lamination.setNumberOfLayers(n_layers)
+    lamination.setTopologyLUTdirectory(lut_dir)
+    if topology is not None:
+        lamination.setTopology(topology)
+    with span('execute', backend=backend):
+        lamination.execute()
+
+    if 'depth' in outputs:
+        depth_data = from_jarray(lamination.getContinuousDepthMeasurement(),
+                                 gwb_data.shape)
+    if 'layers' in outputs:
+        layer_data = from_jarray(lamination.getDiscreteSampledLayers(),
+                                 gwb_data.shape, dtype=np.uint32)
+    if 'boundaries' in outputs:
+        boundary_len = lamination.getLayerBoundarySurfacesLength()
+        boundary_data = from_jarray(lamination.getLayerBoundarySurfaces(),
+                                    (gwb_data.shape[0], gwb_data.shape[1],
+                                     gwb_data.shape[2], boundary_len))
+    memory_usage('layering')
+    return depth_data, layer_data, boundary_data
+
+
+def _run_slabs(func, imgs, outputs, slab_size, halo, n_jobs, backend,
+               n_layers=None):
+    # applies func to slabs along the third axis of the input images, which
+    # are read one slab at a time, and writes the parts of the results
+    # without halo into the output arrays
+    slabs = slab_slices(imgs[0].shape[2], slab_size, halo)
+    if backend == 'cbstools':
+        # start the JVM in this thread with a heap for n_jobs slabs, the
+        # threads of the pool attach to it before using CBS Tools
+        depth = max(outer.stop - outer.start for outer, _, _ in slabs)
+        start_vm(imgs[0].shape[:2] + (depth * max(n_jobs, 1),), n_layers)
+
+    def run(slab):
+        outer, inner, target = slab
+        if backend == 'cbstools':
+            start_vm()
+        results = func(*[np.asarray(img.dataobj[:, :, outer])
+                         for img in imgs])
+        for out, result in zip(outputs, results):
+            out[:, :, target] = result[:, :, inner]
+
+    if n_jobs > 1:
+        pool = ThreadPool(n_jobs)
+        try:
+            pool.map(run, slabs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for slab in slabs:
+            run(slab)
+    for out in outputs:
+        out.flush()
+
+
+@instrumented
+def create_levelsets(tissue_prob_img, save_data=True, base_name=None,
+                     crop=False, crop_margin=5., backend='cbstools',
+                     slab_size=None, slab_halo=5., n_jobs=1,
+                     encoding='float32', band=None):
 
     '''
     Creates levelset surface representations from a tissue classification.
@@ -26,35 +161,52 @@ def create_levelsets(tissue_prob_img, save_data=True, base_name=None):
             directory or a full filename. The suffix 'levelset' will be added
             to the filename. If None (default), the output will be saved to the
             current directory.
+        crop : Whether the levelset should only be computed within the
+            bounding box of the surface plus a margin (default is 'False').
+            Outside the box the distance to the box of the surface is used,
+            which is a lower bound of the true distance.
+        crop_margin : Margin in mm added around the surface when cropping
+            (default is 5). Levelset values are exact up to this distance
+            from the surface, so it should exceed the cortical thickness if
+            the levelset is used for layering.
+        backend : 'cbstools' (default) to run SurfaceProbabilityToLevelset in
+            the JVM, or 'numpy' to compute the signed distance with SciPy's
+            Euclidean distance transform (no JVM needed). Both place the
+            surface at probability 0.5 with sub-voxel accuracy and use the
+            voxel sizes from the header.
+        slab_size : If given, the volume is processed in slabs of this many
+            voxels along the third axis, so that only a few slabs have to be
+            held in memory (see "layering"). Requires save_data. The levelset
+            is saved uncompressed with the suffix 'levelset.nii' and returned
+            memory-mapped from the file. crop and the cache are not used.
+        slab_halo : Margin in mm added to either side of each slab (default
+            is 5). Levelset values are exact up to this distance from the
+            surface and clipped to [-slab_halo, slab_halo] beyond it, as
+            with band=slab_halo, so voxels further from the surface have
+            exactly these values.
+        n_jobs : Number of slabs processed in parallel threads (default is 1)
+        encoding : Data type the levelset is saved with, 'float32' (default)
+            or 'int16' (see "layering")
+        band : If given, levelset values are clipped to [-band, band] mm,
+            which keeps the surface and the sign of all voxels but makes
+            'int16' files more precise and compress better. It should exceed
+            the cortical thickness if the levelset is used for layering.
 
         Returns
         -------
         Levelset representation of surface as Nibabel image object
     '''
 
+    if backend not in ('cbstools', 'numpy'):
+        raise ValueError("backend must be 'cbstools' or 'numpy'")
+    if encoding not in ('float32', 'int16'):
+        raise ValueError("encoding must be 'float32' or 'int16'")
+
     # load the data as well as filenames and headers for saving later
     prob_img = load_volume(tissue_prob_img)
-    prob_data = prob_img.get_data()
     hdr = prob_img.get_header()
     aff = prob_img.get_affine()
-
-    try:
-        cbstoolsjcc.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
-
-    prob2level = cbstoolsjcc.SurfaceProbabilityToLevelset()
-
-    prob2level.setProbabilityImage(cbstoolsjcc.JArray('float')((prob_data.flatten('F')).astype(float)))
-    prob2level.setDimensions(prob_data.shape)
     zooms = [x.item() for x in hdr.get_zooms()]
-    prob2level.setResolutions(zooms[0], zooms[1], zooms[2])
-    prob2level.execute()
-
-    levelset_data = np.reshape(np.array(prob2level.getLevelSetImage(),
-                               dtype=np.float32), prob_data.shape, 'F')
-
-    levelset_img = nb.Nifti1Image(levelset_data, aff, hdr)
 
     if save_data:
         if base_name:
@@ -69,13 +221,86 @@ def create_levelsets(tissue_prob_img, save_data=True, base_name=None):
                 base_name = os.path.join(dir_name,
                                          base_name[:base_name.find('.')]) + '_'
 
-        save_volume(base_name+'levelset.nii.gz', levelset_img)
+    if slab_size is not None:
+        if not save_data:
+            raise ValueError('slab_size requires save_data')
+        halo = int(np.ceil(slab_halo / zooms[2]))
+        # distances are exact up to the halo and clipped beyond it, where
+        # the nearest surface can lie in another slab
+        limit = slab_halo if band is None else min(band, slab_halo)
+
+        def slab_levelset(prob):
+            inside = prob >= 0.5
+            # the surface is further than the halo from slabs without it
+            if inside.all() or not inside.any():
+                return [np.where(inside, -limit, limit).astype(np.float32)]
+            return [clip_band(_levelset_data(prob, zooms, backend), limit)]
+
+        levelset_data = volume_memmap(base_name+'levelset.nii',
+                                      prob_img.shape[:3], aff, hdr)
+        _run_slabs(slab_levelset, [prob_img], [levelset_data], slab_size,
+                   halo, n_jobs, backend)
+        del levelset_data
+        return nb.load(base_name+'levelset.nii')
+
+    prob_data = load_data(prob_img, np.float32)
+
+    cached = None
+    if cache_enabled():
+        key = cache_key([prob_data], aff, zooms, stage='create_levelsets',
+                        backend=backend, version=_backend_version(backend),
+                        crop=crop and crop_margin)
+        cached = load_cached(key, ['levelset'])
+
+    bbox = None
+    if crop and cached is None:
+        inside = prob_data >= 0.5
+        boundary = boundary_voxels(inside)
+        surface = bounding_box(boundary)
+        margin = [int(np.ceil(crop_margin / z)) for z in zooms[:3]]
+        bbox = bounding_box(boundary, margin)
+
+    if cached is not None:
+        levelset_img = cached[0]
+
+    elif bbox is not None:
+        levelset_data = _levelset_data(prob_data[bbox], zooms, backend)
+        # outside the box use the distance to the box around the surface
+        dist = 0
+        for axis, (s, z) in enumerate(zip(surface, zooms)):
+            idx = np.arange(prob_data.shape[axis])
+            d = np.maximum(np.maximum(s.start - idx, idx - s.stop + 1), 0) * z
+            shape = [1, 1, 1]
+            shape[axis] = -1
+            dist = dist + np.reshape(d.astype(np.float32) ** 2, shape)
+        fill = np.sqrt(dist)
+        fill[inside] *= -1
+        levelset_data = paste_volume(levelset_data, bbox, fill)
+
+    else:
+        levelset_data = _levelset_data(prob_data, zooms, backend)
+
+    if cached is None:
+        levelset_img = nb.Nifti1Image(levelset_data, aff, hdr)
+        if cache_enabled():
+            store_cached(key, ['levelset'], [levelset_img])
+
+    if band is not None:
+        levelset_img = nb.Nifti1Image(clip_band(levelset_img.get_data(), band),
+                                      aff, hdr)
+
+    if save_data:
+        save_volume(base_name+'levelset.nii.gz', levelset_img, dtype=encoding)
 
     return levelset_img
 
 
-def layering(gwb_levelset, cgb_levelset, n_layers=10, lut_dir='lookuptables/',
-             save_data=True, base_name=None):
+@instrumented
+def layering(gwb_levelset, cgb_levelset, n_layers=10, lut_dir=None,
+             save_data=True, base_name=None, crop=False, crop_margin=2.,
+             backend='cbstools', n_jobs=1, topology=None, slab_size=None,
+             slab_halo=5., encoding='float32', band=None,
+             outputs=LAYERING_OUTPUTS):
 
     '''
     Equivolumetric layering of the cortical sheet.
@@ -92,8 +317,9 @@ def layering(gwb_levelset, cgb_levelset, n_layers=10, lut_dir='lookuptables/',
             created from tissue segmentation with the "create_levelsets"
             function. Can be path to a Nifti file or Nibabel image object.
         n_layers : int, number of layers to be created.
-        lut_dir : Path to directory with lookup tables. Default is to search it
-            within this directory.
+        lut_dir : Path to directory with lookup tables. Default is the
+            'lookuptables' directory of this package, independent of the
+            working directory.
         save_data : Whether the output layer image should be saved
             (default is 'True').
         base_name : If save_data is set to True, this parameter can be used to
@@ -101,51 +327,364 @@ def layering(gwb_levelset, cgb_levelset, n_layers=10, lut_dir='lookuptables/',
             directory or a full filename. The suffixes 'depth', 'layers' and
             'boundaries' will be added to the respective outputs. If None
             (default), the output will be saved to the current directory.
+        crop : Whether the layering should only be run within the bounding box
+            of the cortex (voxels between the two levelsets) plus a margin
+            (default is 'False'). Outside the box depth is 0 in WM and 1 in
+            CSF, layers are 0 and the boundary levelsets are interpolated
+            linearly between the two input levelsets.
+        crop_margin : Margin in mm added around the cortex when cropping
+            (default is 2). The 'numpy' backend uses at least the margin
+            its depth depends on (see "depth_halo"), so that the cropped
+            results are the same as those of the full volume.
+        backend : 'cbstools' (default) to run LaminarVolumetricLayering in the
+            JVM, or 'numpy' to compute the equivolumetric depth in closed form
+            from the curvature of both levelsets (no JVM needed, lut_dir and
+            topology are ignored). The 'numpy' depth is an approximation of
+            the levelset evolution of CBS Tools (see
+            "numpy_backend.equivolumetric_depth").
+        n_jobs : Number of threads used by the 'numpy' backend (default is 1).
+        topology : Topology constraint of the levelset evolution, one of
+            the keys of lookup_tables.TOPOLOGY_LUTS, e.g. '26/6' or 'wcs'.
+            Only the lookup table for this topology is loaded.
+            Default is the CBS Tools default 'wcs'.
+        slab_size : If given, the volume is processed out of core in slabs of
+            this many voxels along the third axis, each extended by slab_halo
+            on either side. Input slabs are read from the files one at a
+            time, n_jobs slabs are processed in parallel and their results
+            are written into memory-mapped outputs. Requires save_data. The
+            outputs are saved uncompressed with the suffix '.nii' and
+            returned memory-mapped from the files. crop and the cache are
+            not used.
+        slab_halo : Margin in mm added to either side of each slab (default
+            is 5). It should exceed the cortical thickness, so that the
+            layering near the slab edges sees the whole cortex.
+        encoding : Data type depth and boundaries are saved with. 'float32'
+            (default) stores them exactly. 'int16' stores them as 16 bit
+            integers scaled with scl_slope and scl_inter in the Nifti header,
+            halving the files. The error is half a quantisation step, about
+            (max - min) / 131070 of the values in the volume: below 1e-5 for
+            the depth and about band / 65000 mm for the boundaries (8e-5 mm
+            for band=5), by which the boundary surfaces may move. Layers are
+            always stored as the smallest unsigned integer type that holds
+            n_layers (uint8 up to 255 layers), both in memory and on disk.
+            Float16 is not supported by the Nifti format. Slab outputs are
+            always float32.
+        band : If given, the boundary levelsets are clipped to [-band, band]
+            mm, e.g. a few mm beyond the cortical thickness. Surfaces and the
+            side of each voxel are kept exactly, the distances beyond the
+            band are lost. Without it the int16 error grows with the largest
+            distance in the volume.
+        outputs : Outputs to fetch, return and save, any of 'depth',
+            'layers' and 'boundaries' (default is all three). Outputs that
+            are not requested are neither fetched from the JVM (or derived
+            by the 'numpy' backend), nor allocated or saved, e.g. the 4D
+            boundaries, the largest array of the pipeline. The levelset
+            evolution itself is the same for any selection.
 
         Returns
         -------
-        Three Nibabel image objects :
+        Three Nibabel image objects, None for outputs not requested :
             Continuous depth from 0(WM) to 1(CSF)
             Discrete layers from 1(bordering WM) to n_layers(bordering CSF)
             Levelset representations of boundaries between layers (4D)
     '''
 
+    if backend not in ('cbstools', 'numpy'):
+        raise ValueError("backend must be 'cbstools' or 'numpy'")
+    if encoding not in ('float32', 'int16'):
+        raise ValueError("encoding must be 'float32' or 'int16'")
+    if isinstance(outputs, basestring):
+        outputs = [outputs]
+    if not outputs or not set(outputs) <= set(LAYERING_OUTPUTS):
+        raise ValueError("outputs must be a selection of 'depth', 'layers' "
+                         "and 'boundaries'")
+    # requested outputs in the order they are returned
+    names = [name for name in LAYERING_OUTPUTS if name in outputs]
+    labels = label_dtype(n_layers)
+
     # load the data as well as filenames and headers for saving later
     gwb_img = load_volume(gwb_levelset)
-    gwb_data = gwb_img.get_data()
+    cgb_img = load_volume(cgb_levelset)
     hdr = gwb_img.get_header()
     aff = gwb_img.get_affine()
+    zooms = [x.item() for x in hdr.get_zooms()]
+
+    # CBS Tools concatenates the directory and file names
+    lut_dir = os.path.join(lut_dir or LUT_DIR, '')
+    if backend == 'cbstools':
+        # fail before any work if the topology or its table is unknown
+        topology_lut(topology, lut_dir)
 
-    cgb_data = load_volume(cgb_levelset).get_data()
+    if save_data:
+        if base_name:
+            base_name += '_'
+        else:
+            if not isinstance(gwb_levelset, basestring):
+                base_name = os.getcwd() + '/'
+                print "saving to %s" % base_name
+            else:
+                dir_name = os.path.dirname(gwb_levelset)
+                base_name = os.path.basename(gwb_levelset)
+                base_name = os.path.join(dir_name,
+                                         base_name[:base_name.find('.')]) + '_'
 
-    try:
-        cbstoolsjcc.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    if slab_size is not None:
+        if not save_data:
+            raise ValueError('slab_size requires save_data')
+        halo = int(np.ceil(slab_halo / zooms[2]))
+        if backend == 'numpy':
+            halo = max(halo, depth_halo())
 
-    lamination = cbstoolsjcc.LaminarVolumetricLayering()
-    lamination.setDimensions(gwb_data.shape[0], gwb_data.shape[1], gwb_data.shape[2])
-    zooms = [x.item() for x in hdr.get_zooms()]
-    lamination.setResolutions(zooms[0], zooms[1], zooms[2])
+        def slab_layering(gwb, cgb):
+            if not ((gwb >= 0) & (cgb <= 0)).any():
+                # no cortex in this slab, filled as outside the crop box
+                depth = (gwb >= 0).astype(np.float32)
+                results = {'depth': depth,
+                           'layers': np.zeros(gwb.shape, dtype=labels)}
+                if 'boundaries' in names:
+                    results['boundaries'] = depth_to_boundaries(
+                        depth, gwb, cgb, n_layers)
+            else:
+                results = dict(zip(LAYERING_OUTPUTS, _layering_data(
+                    gwb, cgb, zooms, n_layers, lut_dir, topology, backend,
+                    1, names)))
+            if 'boundaries' in names:
+                results['boundaries'] = clip_band(results['boundaries'], band)
+            return [results[name] for name in names]
 
-    lamination.setInnerDistanceImage(cbstoolsjcc.JArray('float')((gwb_data.flatten('F')).astype(float)))
-    lamination.setOuterDistanceImage(cbstoolsjcc.JArray('float')((cgb_data.flatten('F')).astype(float)))
-    lamination.setNumberOfLayers(n_layers)
-    lamination.setTopologyLUTdirectory(lut_dir)
-    lamination.execute()
+        shape = gwb_img.shape[:3]
+        specs = {'depth': (shape, np.float32), 'layers': (shape, labels),
+                 'boundaries': (shape + (n_layers + 1,), np.float32)}
+        slab_outputs = [volume_memmap(base_name + name + '.nii',
+                                      specs[name][0], aff, hdr,
+                                      dtype=specs[name][1])
+                        for name in names]
+        _run_slabs(slab_layering, [gwb_img, cgb_img], slab_outputs,
+                   slab_size, halo, n_jobs, backend, n_layers)
+        del slab_outputs
+        return tuple(nb.load(base_name + name + '.nii') if name in names
+                     else None for name in LAYERING_OUTPUTS)
 
-    depth_data=np.reshape(np.array(lamination.getContinuousDepthMeasurement(), dtype=np.float32),gwb_data.shape,'F')
-    layer_data=np.reshape(np.array(lamination.getDiscreteSampledLayers(), dtype=np.uint32),gwb_data.shape,'F')
+    gwb_data = load_data(gwb_img, np.float32)
+    cgb_data = load_data(cgb_img, np.float32)
 
-    boundary_len = lamination.getLayerBoundarySurfacesLength()
-    boundary_data=np.reshape(np.array(lamination.getLayerBoundarySurfaces(), dtype=np.float32),
-                             (gwb_data.shape[0], gwb_data.shape[1],
-                              gwb_data.shape[2],
-                              boundary_len), 'F')
+    cached = None
+    if cache_enabled():
+        key = cache_key([gwb_data, cgb_data], aff, zooms, stage='layering',
+                        n_layers=n_layers, backend=backend,
+                        version=_backend_version(backend),
+                        lut=(backend == 'cbstools' and
+                             directory_hash(lut_dir)),
+                        topology=topology, crop=crop and crop_margin,
+                        outputs=names)
+        cached = load_cached(key, names)
 
-    depth_img = nb.Nifti1Image(depth_data, aff, hdr)
-    layer_img = nb.Nifti1Image(layer_data, aff, hdr)
-    boundary_img = nb.Nifti1Image(boundary_data, aff, hdr)
+    bbox = None
+    if crop and cached is None:
+        margin = [int(np.ceil(crop_margin / z)) for z in zooms[:3]]
+        if backend == 'numpy':
+            # the depth depends on the levelsets within this many voxels
+            margin = [max(m, depth_halo()) for m in margin]
+        bbox = bounding_box((gwb_data >= 0) & (cgb_data <= 0), margin)
+
+    if cached is not None:
+        imgs = dict(zip(names, cached))
+
+    elif bbox is not None:
+        depth_crop, layer_crop, boundary_crop = \
+            _layering_data(gwb_data[bbox], cgb_data[bbox], zooms, n_layers,
+                           lut_dir, topology, backend, n_jobs, names)
+
+        # there is no cortex outside the box, so every voxel is either in WM
+        # or in CSF and all boundaries lie on one side of it
+        depth_data = layer_data = boundary_data = None
+        fill = (gwb_data >= 0).astype(np.float32)
+        if depth_crop is not None:
+            depth_data = paste_volume(depth_crop, bbox, fill)
+        if layer_crop is not None:
+            layer_data = paste_volume(layer_crop, bbox,
+                                      np.zeros(gwb_data.shape, dtype=labels))
+        if boundary_crop is not None:
+            boundary_data = depth_to_boundaries(fill, gwb_data, cgb_data,
+                                                boundary_crop.shape[3] - 1)
+            boundary_data = paste_volume(boundary_crop, bbox, boundary_data)
+        del fill
+
+    else:
+        depth_data, layer_data, boundary_data = \
+            _layering_data(gwb_data, cgb_data, zooms, n_layers, lut_dir,
+                           topology, backend, n_jobs, names)
+
+    if cached is None:
+        imgs = {}
+        if depth_data is not None:
+            imgs['depth'] = nb.Nifti1Image(depth_data, aff, hdr)
+        if layer_data is not None:
+            imgs['layers'] = nb.Nifti1Image(
+                layer_data.astype(labels, copy=False), aff, hdr)
+            imgs['layers'].set_data_dtype(labels)
+        if boundary_data is not None:
+            imgs['boundaries'] = nb.Nifti1Image(boundary_data, aff, hdr)
+        if cache_enabled():
+            store_cached(key, names, [imgs[name] for name in names])
+
+    if band is not None and 'boundaries' in imgs:
+        imgs['boundaries'] = nb.Nifti1Image(
+            clip_band(imgs['boundaries'].get_data(), band), aff, hdr)
+
+    if save_data:
+        for name in names:
+            save_volume(base_name + name + '.nii.gz', imgs[name],
+                        dtype=labels if name == 'layers' else encoding)
+
+    return tuple(imgs.get(name) for name in LAYERING_OUTPUTS)
+
+
+@instrumented
+def relayer(depth_img, gwb_levelset, cgb_levelset, n_layers_list,
+            save_data=True, base_name=None, outputs=('layers', 'boundaries'),
+            encoding='float32', band=None):
+
+    '''
+    Layers and boundaries for other numbers of layers from the continuous
+    depth of an earlier "layering" run, without running the levelset
+    evolution again and without the JVM.
+
+    Layers are ceil(depth * n_layers) in the cortex and boundaries are
+    derived as by the 'numpy' backend (see "depth_to_boundaries"). For
+    depth from the 'cbstools' backend they follow the depth exactly rather
+    than the evolution of each boundary under the topology constraint, so
+    they can differ from a full run by about a voxel.
+
+        Parameters
+        -----------
+        depth_img : Continuous depth as returned or saved by "layering". Can
+            be path to a Nifti file or Nibabel image object.
+        gwb_levelset, cgb_levelset : Levelsets the depth was computed from
+            (see "layering")
+        n_layers_list : int or list of numbers of layers, e.g. range(3, 21)
+        save_data : Whether the outputs should be saved (default is 'True')
+        base_name : If save_data is set to True, this parameter can be used to
+            specify where the outputs should be saved. The suffixes
+            'layers<n>' and 'boundaries<n>' will be added for n layers. If
+            None (default), the outputs are saved next to depth_img or to
+            the current directory.
+        outputs : Outputs to compute, 'layers' and/or 'boundaries' (default
+            is both)
+        encoding, band : see "layering"
+
+        Returns
+        -------
+        Dictionary with the number of layers as keys and tuples of layer and
+        boundary images (None if not requested) as values. All of them are
+        held in memory, so for long lists of boundaries set save_data and
+        load the files when needed.
+    '''
+
+    if isinstance(outputs, basestring):
+        outputs = [outputs]
+    if not outputs or not set(outputs) <= set(('layers', 'boundaries')):
+        raise ValueError("outputs must be a selection of 'layers' and "
+                         "'boundaries'")
+    if encoding not in ('float32', 'int16'):
+        raise ValueError("encoding must be 'float32' or 'int16'")
+    if isinstance(n_layers_list, (int, np.integer)):
+        n_layers_list = [n_layers_list]
+
+    depth_img = load_volume(depth_img)
+    hdr = depth_img.get_header()
+    aff = depth_img.get_affine()
+    depth_data = load_data(depth_img, np.float32)
+    gwb_data = load_data(gwb_levelset, np.float32)
+    cgb_data = load_data(cgb_levelset, np.float32)
+
+    if save_data:
+        if base_name:
+            base_name += '_'
+        else:
+            if not isinstance(depth_img.get_filename(), basestring):
+                base_name = os.getcwd() + '/'
+                print "saving to %s" % base_name
+            else:
+                fname = depth_img.get_filename()
+                dir_name = os.path.dirname(fname)
+                base_name = os.path.basename(fname)
+                base_name = os.path.join(dir_name,
+                                         base_name[:base_name.find('.')]) + '_'
+
+    results = {}
+    layerings = relayer_depth(depth_data, gwb_data, cgb_data, n_layers_list,
+                              'layers' in outputs, 'boundaries' in outputs)
+    for n_layers, layer_data, boundary_data in layerings:
+        layer_img = boundary_img = None
+        if layer_data is not None:
+            labels = label_dtype(n_layers)
+            layer_img = nb.Nifti1Image(layer_data.astype(labels), aff, hdr)
+            layer_img.set_data_dtype(labels)
+            if save_data:
+                save_volume(base_name + 'layers%i.nii.gz' % n_layers,
+                            layer_img, dtype=labels)
+        if boundary_data is not None:
+            boundary_img = nb.Nifti1Image(clip_band(boundary_data, band),
+                                          aff, hdr)
+            if save_data:
+                save_volume(base_name + 'boundaries%i.nii.gz' % n_layers,
+                            boundary_img, dtype=encoding)
+        results[n_layers] = (layer_img, boundary_img)
+    memory_usage('relayer')
+    return results
+
+
+@instrumented
+def preview_layering(gwb_levelset, cgb_levelset, n_layers=10, factor=2,
+                     levelsets=True, save_data=True, base_name=None,
+                     backend='numpy'):
+
+    '''
+    Quick look at the depth and layers of a subject for quality control.
+    The inputs are downsampled by averaging blocks of factor voxels per axis,
+    layered on the coarse grid and the results interpolated back onto the
+    original grid, so that they can be overlaid on the anatomy. With a
+    factor of 2 this takes about an eighth of the time and memory of a full
+    run, but thin or tightly folded parts of the cortex are lost.
+
+        Parameters
+        -----------
+        gwb_levelset, cgb_levelset : Levelsets of the GM/WM and CSF/GM
+            surfaces (see "layering"), or tissue classifications if
+            levelsets is False. Can be paths to Nifti files or Nibabel
+            image objects.
+        n_layers : Number of layers (default is 10)
+        factor : Downsampling factor, int or sequence of three ints
+            (default is 2)
+        levelsets : Whether the inputs are levelsets (default is 'True'). If
+            False the levelsets are created from the tissue classifications
+            on the coarse grid.
+        save_data : Whether the outputs should be saved (default is 'True')
+        base_name : If save_data is set to True, this parameter can be used to
+            specify where the outputs should be saved. The suffixes
+            'preview_depth' and 'preview_layers' will be added. If None
+            (default), the outputs are saved next to gwb_levelset or to the
+            current directory.
+        backend : 'numpy' (default, no JVM needed) or 'cbstools' (see
+            "layering")
+
+        Returns
+        -------
+        Tuple of depth and layer images on the original grid
+    '''
+
+    if backend not in ('cbstools', 'numpy'):
+        raise ValueError("backend must be 'cbstools' or 'numpy'")
+    factor = np.broadcast_to(factor, (3,)).astype(int)
+    if np.any(factor < 1):
+        raise ValueError("factor must be a positive integer")
+
+    gwb_img = load_volume(gwb_levelset)
+    cgb_img = load_volume(cgb_levelset)
+    hdr = gwb_img.get_header()
+    aff = gwb_img.get_affine()
+    shape = gwb_img.shape[:3]
 
     if save_data:
         if base_name:
@@ -160,15 +699,188 @@ def layering(gwb_levelset, cgb_levelset, n_layers=10, lut_dir='lookuptables/',
                 base_name = os.path.join(dir_name,
                                          base_name[:base_name.find('.')]) + '_'
 
-        save_volume(base_name + 'depth.nii.gz', depth_img)
-        save_volume(base_name + 'layers.nii.gz', layer_img)
-        save_volume(base_name + 'boundaries.nii.gz', boundary_img)
+    # the coarse header takes its voxel sizes from the affine
+    coarse_aff = downsample_affine(aff, factor)
+    coarse_imgs = []
+    for img in (gwb_img, cgb_img):
+        coarse_img = nb.Nifti1Image(
+            downsample_data(load_data(img, np.float32), factor), coarse_aff,
+            hdr)
+        coarse_img.set_data_dtype(np.float32)
+        if not levelsets:
+            coarse_img = create_levelsets(coarse_img, save_data=False,
+                                          backend=backend)
+        coarse_imgs.append(coarse_img)
+
+    depth_img, layer_img, _ = layering(coarse_imgs[0], coarse_imgs[1],
+                                       n_layers=n_layers, save_data=False,
+                                       backend=backend,
+                                       outputs=('depth', 'layers'))
+
+    labels = label_dtype(n_layers)
+    depth_img = nb.Nifti1Image(
+        upsample_data(load_data(depth_img, np.float32), factor, shape),
+        aff, hdr)
+    depth_img.set_data_dtype(np.float32)
+    layer_img = nb.Nifti1Image(
+        upsample_data(np.asarray(layer_img.dataobj, dtype=labels), factor,
+                      shape, order=0), aff, hdr)
+    layer_img.set_data_dtype(labels)
+    memory_usage('preview_layering')
+
+    if save_data:
+        save_volume(base_name + 'preview_depth.nii.gz', depth_img)
+        save_volume(base_name + 'preview_layers.nii.gz', layer_img,
+                    dtype=labels)
+
+    return depth_img, layer_img
+
+
+def _intensity_volumes(intensity_img):
+    # the number of 3D volumes in a single image or list, whether they form
+    # a series, and a function returning a generator over the volumes that
+    # reads series chunk_size volumes at a time
+    series = isinstance(intensity_img, (list, tuple))
+    if not series:
+        intensity_img = [intensity_img]
+    imgs = [load_volume(img) for img in intensity_img]
+    n_volumes = sum(img.shape[3] if len(img.shape) > 3 else 1 for img in imgs)
+    series = series or len(imgs[0].shape) > 3
+
+    def volumes(chunk_size):
+        for img in imgs:
+            if len(img.shape) == 3:
+                yield np.asarray(img.dataobj)
+                continue
+            for start in range(0, img.shape[3], chunk_size):
+                block = np.asarray(img.dataobj[..., start:start + chunk_size])
+                for t in range(block.shape[3]):
+                    yield block[..., t]
+
+    return n_volumes, series, volumes
+
 
-    return depth_img, layer_img, boundary_img
+def _chunk_size(boundary_data, mask, memory_limit, compact):
+    # number of volumes that can be sampled at once within memory_limit (in
+    # MB), next to the boundaries and the profile positions
+    n_voxels = np.prod(boundary_data.shape[:3])
+    n_boundaries = boundary_data.shape[3]
+    n_profiles = np.count_nonzero(mask) if compact else n_voxels
+    fixed = 4. * boundary_data.size + 12. * mask.sum() * n_boundaries + \
+        16. * n_voxels
+    per_volume = 8. * n_voxels + 4. * n_profiles * n_boundaries
+    return max(int((memory_limit * 2 ** 20 - fixed) // per_volume), 1)
 
 
+def _profile_chunks(boundary_data, zooms, mask, volumes, n_volumes,
+                    chunk_size, backend, compact):
+    # samples the volumes against the boundaries and yields the profiles of
+    # chunk_size volumes at a time as (start, stop, profiles)
+    if backend == 'numpy':
+        with span('execute', backend=backend):
+            _, positions = numpy_backend.profile_positions(boundary_data,
+                                                           zooms)
+    else:
+        start_vm(boundary_data.shape)
+        sampler = cbstools().LaminarProfileSampling()
+        sampler.setProfileSurfaceImage(to_jarray(boundary_data))
+        sampler.setResolutions(zooms[0], zooms[1], zooms[2])
+        sampler.setDimensions(boundary_data.shape)
+
+    if compact:
+        shape = (np.count_nonzero(mask), boundary_data.shape[3])
+    else:
+        shape = boundary_data.shape
+    volumes = volumes(chunk_size)
+    for start in range(0, n_volumes, chunk_size):
+        stop = min(start + chunk_size, n_volumes)
+        profile_data = np.zeros(shape + (stop - start,), dtype=np.float32,
+                                order='F')
+        for i in range(stop - start):
+            intensity_data = next(volumes)
+            if backend == 'numpy':
+                with span('execute', backend=backend):
+                    profiles = numpy_backend.sample_profiles(intensity_data,
+                                                             positions)
+                if compact:
+                    profile_data[..., i] = profiles
+                else:
+                    profile_data[..., i][mask] = profiles
+            else:
+                sampler.setIntensityImage(to_jarray(intensity_data))
+                with span('execute', backend=backend):
+                    sampler.execute()
+                profiles = from_jarray(
+                    sampler.getProfileMappedIntensityImage(),
+                    boundary_data.shape)
+                profile_data[..., i] = profiles[mask] if compact else profiles
+        yield start, stop, profile_data
+
+
+def _save_npy_chunks(fname, chunks, shape):
+    # writes a float32 .npy file chunk by chunk along its last axis, which
+    # is contiguous in Fortran order
+    with open(fname, 'wb') as f:
+        np.lib.format.write_array_header_1_0(
+            f, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                'fortran_order': True, 'shape': tuple(shape)})
+        for chunk in chunks:
+            f.write(np.asarray(chunk, dtype=np.float32).tobytes(order='F'))
+
+
+def profile_sampling_chunks(boundary_img, intensity_img, memory_limit=4000.,
+                            backend='cbstools', compact=False):
+
+    '''
+    Generator version of "profile_sampling" for long time series. The
+    volumes are read, sampled and yielded in chunks, so that only one chunk
+    of the input and its profiles are held in memory at a time.
+
+        Parameters
+        -----------
+        boundary_img : Levelset representations of different intracortical
+            layers in a 4D image (4th dimensions representing the layers).
+            Can be path to a Nifti file or Nibabel image object.
+        intensity_img : Image from which data should be sampled. Can be path to
+            a Nifti file or Nibabel image object, a 4D image (e.g. a time
+            series) or a list of these.
+        memory_limit : Approximate memory in MB to be used for the
+            boundaries, the input volumes and the profiles together (default
+            is 4000). At least one volume is sampled per chunk.
+        backend : 'cbstools' (default) or 'numpy', see "profile_sampling"
+        compact : Whether to return only the profiles of the cortical voxels,
+            i.e. where the first boundary levelset is >= 0 and the last one
+            <= 0 (default is 'False').
+
+        Yields
+        -------
+        Tuples of the index of the first and one past the last volume of the
+        chunk, and a float32 numpy array with the profiles of these volumes,
+        of shape (x, y, z, n_layers + 1, n_chunk) or, if compact is True,
+        (n_voxels, n_layers + 1, n_chunk) with the voxels ordered as in
+        "numpy.nonzero" of the cortex mask.
+    '''
+
+    if backend not in ('cbstools', 'numpy'):
+        raise ValueError("backend must be 'cbstools' or 'numpy'")
+
+    boundary_img = load_volume(boundary_img)
+    boundary_data = load_data(boundary_img, np.float32)
+    zooms = [x.item() for x in boundary_img.get_header().get_zooms()]
+
+    n_volumes, series, volumes = _intensity_volumes(intensity_img)
+    mask = (boundary_data[..., 0] >= 0) & (boundary_data[..., -1] <= 0)
+    chunk_size = _chunk_size(boundary_data, mask, memory_limit, compact)
+    for chunk in _profile_chunks(boundary_data, zooms, mask, volumes,
+                                 n_volumes, chunk_size, backend, compact):
+        yield chunk
+    memory_usage('profile_sampling')
+
+
+@instrumented
 def profile_sampling(boundary_img, intensity_img,
-                     save_data=True, base_name=None):
+                     save_data=True, base_name=None, backend='cbstools',
+                     compact=False, memory_limit=None):
 
     '''
     Sampling data on multiple intracortical layers.
@@ -180,7 +892,9 @@ def profile_sampling(boundary_img, intensity_img,
             Can be created from GM and WM leveset with the "layering" function.
             Can be path to a Nifti file or Nibabel image object.
         intensity_img : Image from which data should be sampled. Can be path to
-            a Nifti file or Nibabel image object.
+            a Nifti file or Nibabel image object, a 4D image (e.g. a time
+            series) or a list of these. The boundaries are only passed once
+            and all volumes are sampled against them.
         save_data : Whether the output profile image should be saved
             (default is 'True').
         base_name : If save_data is set to True, this parameter can be used to
@@ -188,60 +902,115 @@ def profile_sampling(boundary_img, intensity_img,
             directory or a full filename. The suffix 'profiles' will be added
             to filename. If None (default), the output will be saved to the
             current directory.
+        backend : 'cbstools' (default) to run LaminarProfileSampling in the
+            JVM, or 'numpy' to compute the profile positions once by Newton
+            steps onto each boundary levelset and sample all volumes there
+            with trilinear interpolation (no JVM needed).
+        compact : Whether to return only the profiles of the cortical voxels
+            instead of the whole volume (default is 'False').
+        memory_limit : If given, the volumes are sampled in chunks that fit
+            into about this many MB and each chunk is written to disk before
+            the next one is read (see "profile_sampling_chunks"). Requires
+            save_data. The profiles are then saved uncompressed, with the
+            suffix 'profiles.nii' instead of 'profiles.nii.gz', and returned
+            memory-mapped from the file. Default is to sample all volumes at
+            once.
 
         Returns
         -------
-        Nibabel image object (4D), where the 4th dimension represents the
-        different cortical surfaces, i.e. the profile for each voxel in the
-        3D space.
+        If compact is False, a Nibabel image object where the 4th dimension
+        represents the different cortical surfaces, i.e. the profile for each
+        voxel in the 3D space. For a 4D or list intensity_img, the 5th
+        dimension represents the sampled volumes.
+
+        If compact is True, a tuple of a float32 numpy array of shape
+        (n_voxels, n_layers + 1, n_volumes) and a Nibabel image object of the
+        mask of these voxels, ordered as in "numpy.nonzero" of the mask. It is
+        saved with the suffixes 'profiles.npy' and 'profile_mask.nii.gz'.
     '''
 
+    if backend not in ('cbstools', 'numpy'):
+        raise ValueError("backend must be 'cbstools' or 'numpy'")
+    if memory_limit is not None and not save_data:
+        raise ValueError('memory_limit requires save_data, use '
+                         'profile_sampling_chunks to process the profiles '
+                         'in memory')
+
     # load the data as well as filenames and headers for saving later
     boundary_img = load_volume(boundary_img)
-    boundary_data = boundary_img.get_data()
+    boundary_data = load_data(boundary_img, np.float32)
     hdr = boundary_img.get_header()
     aff = boundary_img.get_affine()
-
-    intensity_data = load_volume(intensity_img).get_data()
-
-    try:
-        cbstoolsjcc.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
-
-    sampler = cbstoolsjcc.LaminarProfileSampling()
-    sampler.setIntensityImage(cbstoolsjcc.JArray('float')((intensity_data.flatten('F')).astype(float)))
-    sampler.setProfileSurfaceImage(cbstoolsjcc.JArray('float')((boundary_data.flatten('F')).astype(float)))
     zooms = [x.item() for x in hdr.get_zooms()]
-    sampler.setResolutions(zooms[0], zooms[1], zooms[2])
-    sampler.setDimensions(boundary_data.shape)
-    sampler.execute()
-
-    profile_data = np.reshape(np.array(sampler.getProfileMappedIntensityImage(),
-                              dtype=np.float32), boundary_data.shape,'F')
-
-    profile_img = nb.Nifti1Image(profile_data, aff, hdr)
 
     if save_data:
         if base_name:
             base_name += '_'
         else:
-            if not isinstance(intensity_img, basestring):
+            first_img = intensity_img
+            if isinstance(intensity_img, (list, tuple)):
+                first_img = intensity_img[0]
+            if not isinstance(first_img, basestring):
                 base_name = os.getcwd() + '/'
                 print "saving to %s" % base_name
             else:
-                dir_name = os.path.dirname(intensity_img)
-                base_name = os.path.basename(intensity_img)
+                dir_name = os.path.dirname(first_img)
+                base_name = os.path.basename(first_img)
                 base_name = os.path.join(dir_name,
                                          base_name[:base_name.find('.')]) + '_'
-        save_volume(base_name+'profiles.nii.gz', profile_img)
 
+    n_volumes, series, volumes = _intensity_volumes(intensity_img)
+    mask = (boundary_data[..., 0] >= 0) & (boundary_data[..., -1] <= 0)
+    if memory_limit is None:
+        chunk_size = n_volumes
+    else:
+        chunk_size = _chunk_size(boundary_data, mask, memory_limit, compact)
+    chunks = (profile_data for _, _, profile_data in
+              _profile_chunks(boundary_data, zooms, mask, volumes, n_volumes,
+                              chunk_size, backend, compact))
+    if not (series or compact):
+        chunks = (profile_data[..., 0] for profile_data in chunks)
+
+    if compact:
+        mask_img = nb.Nifti1Image(mask.astype(np.uint8), aff, hdr)
+        mask_img.set_data_dtype(np.uint8)
+        shape = (np.count_nonzero(mask), boundary_data.shape[3], n_volumes)
+    else:
+        shape = boundary_data.shape + ((n_volumes,) if series else ())
+
+    if memory_limit is not None:
+        # write each chunk before sampling the next one
+        if compact:
+            _save_npy_chunks(base_name+'profiles.npy', chunks, shape)
+            profile_data = np.load(base_name+'profiles.npy', mmap_mode='r')
+        else:
+            save_volume_chunks(base_name+'profiles.nii', chunks, shape, aff,
+                               hdr)
+            profile_img = nb.load(base_name+'profiles.nii')
+    else:
+        profile_data = next(chunks)
+        if not compact:
+            profile_img = nb.Nifti1Image(profile_data, aff, hdr)
+    memory_usage('profile_sampling')
+
+    if save_data and memory_limit is None:
+        if compact:
+            np.save(base_name+'profiles.npy', profile_data)
+        else:
+            save_volume(base_name+'profiles.nii.gz', profile_img)
+    if save_data and compact:
+        save_volume(base_name+'profile_mask.nii.gz', mask_img, dtype='uint8')
+
+    if compact:
+        return profile_data, mask_img
     return profile_img
 
 
-# There is something wrong with this, all the created surfaces have the same
-# vertex coordinates
-def profile_meshing(profile_file, surf_mesh, save_data=True, base_name=None):
+# With the 'cbstools' backend all the created surfaces have been reported to
+# have the same vertex coordinates, the 'numpy' backend does not use it
+@instrumented
+def profile_meshing(profile_file, surf_mesh, save_data=True, base_name=None,
+                    save_format='vtk', backend='cbstools'):
 
     '''
     Converting the levelset representation of multiple intracorticle surfaces
@@ -262,50 +1031,75 @@ def profile_meshing(profile_file, surf_mesh, save_data=True, base_name=None):
             directory or a full filename. A suffix indicating the number of the
             layer will be added. If None (default), the output will be saved to
             the current directory.
+        save_format : 'vtk' (default) to save one vtk file per layer, or 'npz'
+            or 'gii' to save all layers in one file with the suffix 'layers',
+            which stores the triangles only once (see "save_layered_mesh").
+        backend : 'cbstools' (default) to run LaminarProfileMeshing in the
+            JVM, or 'numpy' to move all vertices onto each boundary levelset
+            at once by Newton steps along its gradient, starting from the
+            reference mesh for the first boundary and from the previous
+            boundary for the others (no JVM needed). Both expect mesh
+            coordinates in voxel space scaled by the voxel sizes.
 
         Returns
         -------
         A list of intracortical surface meshes, each represented as a
-        dictionary with entries 'coords' and 'faces'
+        dictionary with entries 'coords' and 'faces'. All meshes share the
+        same faces array.
     '''
 
+    if backend not in ('cbstools', 'numpy'):
+        raise ValueError("backend must be 'cbstools' or 'numpy'")
+
     profile_img = load_volume(profile_file)
-    profile_data = profile_img.get_data()
+    profile_data = load_data(profile_img, np.float32)
     profile_len = profile_data.shape[3]
     hdr = profile_img.get_header()
-    aff = profile_img.get_affine()
+    zooms = [x.item() for x in hdr.get_zooms()]
 
-    in_coords = load_mesh_geometry(surf_mesh)['coords']
-    in_faces = load_mesh_geometry(surf_mesh)['faces']
+    in_mesh = load_mesh_geometry(surf_mesh)
+    in_coords = in_mesh['coords']
+    in_faces = np.asarray(in_mesh['faces'], dtype=np.int32)
 
-    try:
-        cbstoolsjcc.initVM(initialheap='6000m', maxheap='6000m')
-    except ValueError:
-        pass
+    if backend == 'numpy':
+        points = (np.asarray(in_coords, dtype=np.float32) /
+                  np.asarray(zooms[:3], dtype=np.float32)).T
+        with span('execute', backend=backend):
+            positions = numpy_backend.levelset_positions(profile_data, zooms,
+                                                         points)
+        # back to scaled voxel space, as (layers, vertices, 3)
+        layer_coords = positions.transpose(2, 1, 0) * \
+            np.asarray(zooms[:3], dtype=np.float32)
+        mesh_list = [{'coords': coords, 'faces': in_faces}
+                     for coords in layer_coords]
+    else:
+        start_vm(profile_data.shape)
 
-    mesher = cbstoolsjcc.LaminarProfileMeshing()
+        mesher = cbstools().LaminarProfileMeshing()
 
-    mesher.setDimensions(profile_data.shape)
-    zooms = [x.item() for x in hdr.get_zooms()]
-    mesher.setResolutions(zooms[0], zooms[1], zooms[2])
+        mesher.setDimensions(profile_data.shape)
+        mesher.setResolutions(zooms[0], zooms[1], zooms[2])
 
-    mesher.setProfileSurfaceImage(cbstoolsjcc.JArray('float')((profile_data.flatten('F')).astype(float)))
-    mesher.setInputSurfacePoints(cbstoolsjcc.JArray('float')(in_coords.flatten().astype(float)))
-    mesher.setInputSurfaceTriangles(cbstoolsjcc.JArray('int')(in_faces.flatten().astype(int)))
+        mesher.setProfileSurfaceImage(to_jarray(profile_data))
+        mesher.setInputSurfacePoints(to_jarray(in_coords, order='C'))
+        mesher.setInputSurfaceTriangles(to_jarray(in_faces, 'int',
+                                                  order='C'))
 
-    mesher.execute()
+        with span('execute', backend=backend):
+            mesher.execute()
 
-    out_coords = np.zeros((in_coords.shape[0], in_coords.shape[1], profile_len))
-    out_faces = np.zeros((in_faces.shape[0], in_faces.shape[1], profile_len))
-
-    mesh_list = []
-    for i in range(profile_len):
-        current_mesh = {}
-        current_mesh['coords'] = np.reshape(np.array(mesher.getSampledSurfacePoints(i),
-                                            dtype=np.float32),in_coords.shape)
-        current_mesh['faces'] =  np.reshape(np.array(mesher.getSampledSurfaceTriangles(i),
-                                            dtype=np.float32),in_faces.shape)
-        mesh_list.append(current_mesh)
+        # the triangles are the same for all layers, so they are only
+        # fetched once, the wrapper has no getter for all points at once
+        faces = from_jarray(mesher.getSampledSurfaceTriangles(0),
+                            in_faces.shape, dtype=np.int32, order='C')
+        mesh_list = []
+        for i in range(profile_len):
+            current_mesh = {}
+            current_mesh['coords'] = from_jarray(
+                mesher.getSampledSurfacePoints(i), in_coords.shape, order='C')
+            current_mesh['faces'] = faces
+            mesh_list.append(current_mesh)
+    memory_usage('profile_meshing')
 
     if save_data:
         if base_name:
@@ -315,12 +1109,18 @@ def profile_meshing(profile_file, surf_mesh, save_data=True, base_name=None):
                 base_name = os.getcwd() + '/'
                 print "saving to %s" % base_name
             else:
-                dir_name = os.path.dirname(intensity_img)
-                base_name = os.path.basename(intensity_img)
+                dir_name = os.path.dirname(profile_file)
+                base_name = os.path.basename(profile_file)
                 base_name = os.path.join(dir_name,
                                          base_name[:base_name.find('.')]) + '_'
 
-        for i in range(len(mesh_list)):
-            save_mesh_geometry(base_name + '%s.vtk' % str(i), mesh_list[i])
+        if save_format == 'vtk':
+            for i in range(len(mesh_list)):
+                save_mesh_geometry(base_name + '%s.vtk' % str(i),
+                                   mesh_list[i])
+        else:
+            save_layered_mesh(base_name + 'layers.' + save_format,
+                              {'coords': [m['coords'] for m in mesh_list],
+                               'faces': mesh_list[0]['faces']})
 
     return mesh_list